@@ -0,0 +1,236 @@
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# A local stand-in for the orchestrator API, implementing just enough of it
+# for the worker's transfer code: work polling, download and upload tokens,
+# ranged downloads, single request and multipart uploads, heartbeats and
+# webhooks. Latency is added to every request and all request and response
+# bodies share one bandwidth limit, like the link of a real node.
+#
+# Objects under synthetic/<size>/<name> exist without being uploaded and
+# hold <size> pseudo-random bytes. Jobs given with --jobs are handed out one
+# per /work request.
+
+
+class Throttle:
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self.available_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, num_bytes):
+        if self.bytes_per_second <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.available_at = max(self.available_at, now) + \
+                num_bytes / self.bytes_per_second
+            delay = self.available_at - now
+        time.sleep(delay)
+
+
+class MockState:
+    def __init__(self, latency, throttle, single_put, jobs=()):
+        self.latency = latency
+        self.throttle = throttle
+        self.single_put = single_put
+        self.jobs = list(jobs)
+        self.objects = {}
+        self.etags = {}
+        self.uploads = {}
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        with self.lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+
+    def put_object(self, bucket, key, data):
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        with self.lock:
+            self.objects[(bucket, key)] = data
+            self.etags[(bucket, key)] = etag
+
+    def get_object(self, bucket, key):
+        if (bucket, key) not in self.objects and key.startswith("synthetic/"):
+            _, size, name = key.split("/", 2)
+            self.put_object(bucket, key, random.Random(
+                name).randbytes(int(size)))
+        return self.objects.get((bucket, key)), self.etags.get((bucket, key))
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    chunk_size = 64 * 1024
+
+    def log_message(self, format, *args):
+        pass
+
+    def parse(self):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        time.sleep(self.server.state.latency)
+        return url.path, query
+
+    def read_body(self):
+        remaining = int(self.headers.get("Content-Length", 0))
+        chunks = []
+        while remaining > 0:
+            chunk = self.rfile.read(min(self.chunk_size, remaining))
+            if not chunk:
+                break
+            self.server.state.throttle.consume(len(chunk))
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b"".join(chunks)
+
+    def respond(self, status, body=b"", headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+        with memoryview(body) as view:
+            for offset in range(0, len(body), self.chunk_size):
+                chunk = view[offset:offset + self.chunk_size]
+                self.server.state.throttle.consume(len(chunk))
+                self.wfile.write(chunk)
+
+    def do_GET(self):
+        state = self.server.state
+        path, query = self.parse()
+        if path == "/work":
+            state.count("work")
+            with state.lock:
+                jobs = [state.jobs.pop(0)] if state.jobs else []
+            return self.respond(200, jobs)
+        if path in ("/download/token", "/upload/token"):
+            state.count(path.strip("/").replace("/", "_"))
+            return self.respond(200, {"token": uuid.uuid4().hex})
+        if path.startswith("/download/"):
+            state.count("download")
+            _, _, bucket, key = path.split("/", 3)
+            data, etag = state.get_object(bucket, key)
+            if data is None:
+                return self.respond(404, b"Object not found")
+            headers = {"ETag": etag}
+            byte_range = self.headers.get("Range")
+            if byte_range is None:
+                return self.respond(200, data, headers)
+            start, end = byte_range.split("=", 1)[1].split("-")
+            start, end = int(start), min(int(end), len(data) - 1)
+            if start >= len(data):
+                return self.respond(416, b"", {"Content-Range": f"bytes */{len(data)}"})
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+            return self.respond(206, data[start:end + 1], headers)
+        return self.respond(404)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_POST(self):
+        state = self.server.state
+        path, query = self.parse()
+        body = self.read_body()
+        if path.startswith("/upload/"):
+            _, _, bucket, key = path.split("/", 3)
+            action = query.get("action")
+            state.count(action)
+            if action == "mpu-create":
+                upload_id = uuid.uuid4().hex
+                with state.lock:
+                    state.uploads[upload_id] = {}
+                return self.respond(200, {"key": key, "uploadId": upload_id})
+            if action == "mpu-complete":
+                parts = state.uploads.pop(query["uploadId"], None)
+                if parts is None:
+                    return self.respond(404, b"Upload not found")
+                numbers = sorted(int(part["partNumber"])
+                                 for part in json.loads(body)["parts"])
+                state.put_object(bucket, key, b"".join(
+                    parts[number] for number in numbers))
+                return self.respond(200, {})
+            return self.respond(400, b"Unknown action")
+        # Heartbeats and the progress, complete and fail webhooks
+        state.count(path.strip("/").split("/")[0])
+        return self.respond(200, {})
+
+    def do_PUT(self):
+        state = self.server.state
+        path, query = self.parse()
+        body = self.read_body()
+        if not path.startswith("/upload/"):
+            return self.respond(404)
+        _, _, bucket, key = path.split("/", 3)
+        action = query.get("action")
+        state.count(action or "put")
+        if action == "mpu-uploadpart":
+            parts = state.uploads.get(query["uploadId"])
+            if parts is None:
+                return self.respond(404, b"Upload not found")
+            number = int(query["partNumber"])
+            with state.lock:
+                parts[number] = body
+            return self.respond(200, {"partNumber": number, "etag": hashlib.md5(body).hexdigest()})
+        if action is None:
+            if not state.single_put:
+                return self.respond(405, b"Single request uploads are not supported")
+            state.put_object(bucket, key, body)
+            return self.respond(200, {}, {"ETag": state.etags[(bucket, key)]})
+        return self.respond(400, b"Unknown action")
+
+    def do_DELETE(self):
+        state = self.server.state
+        path, query = self.parse()
+        action = query.get("action")
+        state.count(action)
+        if path.startswith("/upload/") and action == "mpu-abort":
+            with state.lock:
+                parts = state.uploads.pop(query["uploadId"], None)
+            return self.respond(204 if parts is not None else 404)
+        return self.respond(400, b"Unknown action")
+
+
+def start_server(port=0, latency=0.0, bandwidth=0.0, single_put=True, jobs=()):
+    # Bandwidth is in megabytes per second, 0 means unlimited
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockHandler)
+    server.daemon_threads = True
+    server.state = MockState(latency, Throttle(
+        bandwidth * 1024 * 1024), single_put, jobs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Local stand-in for the orchestrator API")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--bandwidth-mbps", type=float, default=0,
+                        help="shared bandwidth limit in MB/s, 0 for none")
+    parser.add_argument("--no-single-put", action="store_true",
+                        help="reject uploads that are not multipart")
+    parser.add_argument("--jobs", help="JSON file with a list of jobs to hand out")
+    args = parser.parse_args()
+    jobs = []
+    if args.jobs:
+        with open(args.jobs) as file:
+            jobs = json.load(file)
+    server = start_server(args.port, args.latency_ms / 1000,
+                          args.bandwidth_mbps, not args.no_single_put, jobs)
+    print(f"Mock API listening on http://127.0.0.1:{server.server_port}", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
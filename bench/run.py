@@ -0,0 +1,211 @@
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+# Benchmarks the worker's transfer paths against the local mock API in
+# bench/mock_api.py. Every benchmark runs in its own process, so the peak RSS
+# it reports belongs to that benchmark alone, and the mock API runs in a
+# process of its own as well.
+#
+#   python bench/run.py --latency-ms 20 --bandwidth-mbps 100
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = os.path.join(os.path.dirname(bench_dir), "src")
+
+MB = 1024 * 1024
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if len(ordered) == 0:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def timed(calls, function, *args):
+    start = time.monotonic()
+    function(*args)
+    calls.append(time.monotonic() - start)
+
+
+def write_random_file(path, size):
+    with open(path, "wb") as file:
+        for offset in range(0, size, 4 * MB):
+            file.write(os.urandom(min(4 * MB, size - offset)))
+
+
+def make_checkpoint(directory, scale):
+    # Roughly the layout of an SDXL LoRA checkpoint, where the optimizer state
+    # dominates and none of it compresses well
+    os.makedirs(directory, exist_ok=True)
+    for name, size in (("optimizer.bin", int(180 * MB * scale)),
+                       ("pytorch_lora_weights.safetensors", int(90 * MB * scale)),
+                       ("scheduler.bin", 1024),
+                       ("scaler.pt", 1024),
+                       ("random_states_0.pkl", 16 * 1024)):
+        write_random_file(os.path.join(directory, name), size)
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+
+def bench_upload_file(work_dir, scale):
+    from upload import upload_file
+    sizes = [128 * 1024] * 20 + [4 * MB] * 10 + \
+        [int(64 * MB * scale)] * 2 + [int(256 * MB * scale)]
+    calls = []
+    for index, size in enumerate(sizes):
+        path = os.path.join(work_dir, f"file-{index}")
+        write_random_file(path, size)
+        timed(calls, upload_file, path, "bench", f"uploads/file-{index}")
+        os.remove(path)
+    return sum(sizes), calls
+
+
+def bench_concurrently_download(work_dir, scale):
+    from download import concurrently_download
+    count = max(1, int(200 * scale))
+    files = [{"bucket": "bench", "key": f"synthetic/{512 * 1024}/class-{index}",
+              "filename": os.path.join(work_dir, f"class-{index}.png")} for index in range(count)]
+    calls = []
+    timed(calls, concurrently_download, files)
+    return count * 512 * 1024, calls
+
+
+def bench_download_checkpoint(work_dir, scale):
+    from upload import upload_file
+    from checkpoints import download_checkpoint
+    checkpoint_dir = os.path.join(work_dir, "checkpoint-100")
+    make_checkpoint(checkpoint_dir, scale)
+    archive = os.path.join(work_dir, "checkpoint-100.zip")
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as output:
+        for name in os.listdir(checkpoint_dir):
+            output.write(os.path.join(checkpoint_dir, name), arcname=name)
+    shutil.rmtree(checkpoint_dir)
+    upload_file(archive, "bench", "checkpoints/checkpoint-100.zip")
+    size = os.path.getsize(archive)
+    os.remove(archive)
+
+    calls = []
+    output_dir = os.path.join(work_dir, "output")
+    os.makedirs(output_dir)
+    timed(calls, download_checkpoint, "bench",
+          "checkpoints/checkpoint-100.zip", output_dir)
+    return size, calls
+
+
+def bench_zip_checkpoint(work_dir, scale):
+    from checkpoints import zip_checkpoint
+    checkpoint_dir = os.path.join(work_dir, "checkpoint-200")
+    size = make_checkpoint(checkpoint_dir, scale)
+    calls = []
+    timed(calls, zip_checkpoint, checkpoint_dir, "bench", "checkpoints/")
+    return size, calls
+
+
+BENCHMARKS = {
+    "upload_file": bench_upload_file,
+    "concurrently_download": bench_concurrently_download,
+    "download_checkpoint": bench_download_checkpoint,
+    "zip_checkpoint": bench_zip_checkpoint,
+}
+
+
+def run_one(name, api_url, scale):
+    # Runs in a child process: the worker modules read their configuration
+    # from the environment when they are imported
+    work_dir = tempfile.mkdtemp(prefix=f"bench-{name}-")
+    os.environ.update({
+        "API_URL": api_url,
+        "API_KEY": "bench",
+        "INSTANCE_DIR": os.path.join(work_dir, "instance"),
+        "CLASS_DIR": os.path.join(work_dir, "class"),
+        "OUTPUT_DIR": os.path.join(work_dir, "output-dir"),
+        "UPLOAD_STATE_DIR": os.path.join(work_dir, "upload-state"),
+        "DATA_CACHE_DIR": os.path.join(work_dir, "data-cache"),
+        "PREFETCH_DIR": os.path.join(work_dir, "prefetch"),
+        "LOG_LEVEL": "WARNING",
+    })
+    sys.path.insert(0, src_dir)
+    try:
+        start = time.monotonic()
+        num_bytes, calls = BENCHMARKS[name](work_dir, scale)
+        elapsed = time.monotonic() - start
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {
+        "benchmark": name,
+        "calls": len(calls),
+        "megabytes": round(num_bytes / MB, 1),
+        "mb_per_second": round(num_bytes / MB / max(sum(calls), 1e-9), 1),
+        "p50_ms": round(percentile(calls, 0.5) * 1000, 1),
+        "p99_ms": round(percentile(calls, 0.99) * 1000, 1),
+        "seconds": round(elapsed, 2),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the worker's transfer paths against a local mock API")
+    parser.add_argument("benchmarks", nargs="*",
+                        help=f"benchmarks to run, all of them by default: {', '.join(BENCHMARKS)}")
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--bandwidth-mbps", type=float, default=0,
+                        help="shared bandwidth limit in MB/s, 0 for none")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="multiplier for the size of the large files")
+    parser.add_argument("--no-single-put", action="store_true",
+                        help="make the mock API reject non-multipart uploads")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--api-url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_one(args.child, args.api_url, args.scale)))
+        return
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name}")
+
+    server_command = [sys.executable, os.path.join(bench_dir, "mock_api.py"), "--port", "0",
+                      "--latency-ms", str(args.latency_ms), "--bandwidth-mbps", str(args.bandwidth_mbps)]
+    if args.no_single_put:
+        server_command.append("--no-single-put")
+    server = subprocess.Popen(
+        server_command, stdout=subprocess.PIPE, text=True)
+    try:
+        api_url = server.stdout.readline().strip().rsplit(" ", 1)[-1]
+        results = []
+        for name in args.benchmarks or list(BENCHMARKS):
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", name,
+                                     "--api-url", api_url, "--scale", str(args.scale)],
+                                    check=True, stdout=subprocess.PIPE, text=True).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+    finally:
+        server.terminate()
+        server.wait()
+
+    columns = ["benchmark", "calls", "megabytes", "mb_per_second",
+               "p50_ms", "p99_ms", "seconds", "peak_rss_mb"]
+    widths = [max(len(column), *(len(str(result[column])) for result in results))
+              for column in columns]
+    print("  ".join(column.ljust(width)
+          for column, width in zip(columns, widths)))
+    for result in results:
+        print("  ".join(str(result[column]).ljust(width)
+              for column, width in zip(columns, widths)))
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
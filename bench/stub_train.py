@@ -0,0 +1,112 @@
+import argparse
+import os
+import re
+import shutil
+import signal
+import sys
+import time
+
+# Stands in for a diffusers training script, so the worker can be run end to
+# end on a machine without GPUs:
+#
+#   TRAINING_LAUNCHER=python TRAINING_SCRIPT=bench/stub_train.py python src/main.py
+#
+# It takes the same arguments, prints a tqdm style progress bar, saves
+# checkpoints the way accelerate's save_state does (random_states_0.pkl last)
+# and resumes from the latest one. STUB_STEP_SECONDS sets the time per step
+# and STUB_CHECKPOINT_MB the size of each checkpoint. Loading each base model
+# takes STUB_MODEL_LOAD_SECONDS, unless the stub backend of the training
+# daemon has it resident. On SIGUSR1 (run the worker with
+# PREEMPT_SIGNAL=SIGUSR1) it checkpoints the current step and exits.
+
+
+def write_file(path, size):
+    with open(path, "wb") as file:
+        file.write(os.urandom(size))
+
+
+def save_checkpoint(output_dir, step, size, total_limit):
+    checkpoints = sorted((name for name in os.listdir(output_dir) if re.fullmatch(r"checkpoint-\d+", name)),
+                         key=lambda name: int(name.split("-")[1]))
+    if total_limit is not None:
+        for name in checkpoints[:max(0, len(checkpoints) - total_limit + 1)]:
+            shutil.rmtree(os.path.join(output_dir, name))
+    checkpoint_dir = os.path.join(output_dir, f"checkpoint-{step}")
+    os.makedirs(checkpoint_dir)
+    write_file(os.path.join(checkpoint_dir, "optimizer.bin"), size * 2 // 3)
+    write_file(os.path.join(checkpoint_dir,
+               "pytorch_lora_weights.safetensors"), size // 3)
+    write_file(os.path.join(checkpoint_dir, "scheduler.bin"), 1024)
+    write_file(os.path.join(checkpoint_dir, "random_states_0.pkl"), 16 * 1024)
+
+
+def latest_checkpoint(output_dir):
+    steps = [int(name.split("-")[1]) for name in os.listdir(output_dir)
+             if re.fullmatch(r"checkpoint-\d+", name)]
+    return max(steps, default=0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output_dir", required=True)
+    parser.add_argument("--pretrained_model_name_or_path")
+    parser.add_argument("--pretrained_vae_model_name_or_path")
+    parser.add_argument("--instance_data_dir")
+    parser.add_argument("--max_train_steps", type=int, default=100)
+    parser.add_argument("--num_train_epochs", type=int)
+    parser.add_argument("--checkpointing_steps", type=int, default=50)
+    parser.add_argument("--checkpoints_total_limit", type=int)
+    parser.add_argument("--resume_from_checkpoint")
+    args, _ = parser.parse_known_args()
+
+    step_seconds = float(os.getenv("STUB_STEP_SECONDS", "0.05"))
+    checkpoint_size = int(
+        float(os.getenv("STUB_CHECKPOINT_MB", "1")) * 1024 * 1024)
+    total_steps = args.max_train_steps
+    if args.num_train_epochs is not None:
+        total_steps = args.num_train_epochs * 10
+
+    resident = os.getenv("STUB_RESIDENT_MODELS", "").split(",")
+    for model in (args.pretrained_model_name_or_path, args.pretrained_vae_model_name_or_path):
+        if model is not None and model != "None" and model not in resident:
+            print(f"Loading {model}", flush=True)
+            time.sleep(float(os.getenv("STUB_MODEL_LOAD_SECONDS", "0")))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    first_step = latest_checkpoint(
+        args.output_dir) if args.resume_from_checkpoint else 0
+    images = len(os.listdir(args.instance_data_dir)
+                 ) if args.instance_data_dir else 0
+    print(f"Stub training on CUDA_VISIBLE_DEVICES={os.getenv('CUDA_VISIBLE_DEVICES')} "
+          f"with {images} instance images, steps {first_step}-{total_steps}", flush=True)
+
+    preempted = []
+    signal.signal(signal.SIGUSR1, lambda sig, frame: preempted.append(sig))
+
+    start = time.monotonic()
+    for step in range(first_step + 1, total_steps + 1):
+        time.sleep(step_seconds)
+        elapsed = time.monotonic() - start
+        rate = (step - first_step) / max(elapsed, 1e-6)
+        remaining = (total_steps - step) / rate
+        sys.stderr.write(f"\rSteps: {step * 100 // total_steps:3d}%| | {step}/{total_steps} "
+                         f"[{int(elapsed) // 60:02d}:{int(elapsed) % 60:02d}<{int(remaining) // 60:02d}:{int(remaining) % 60:02d}, "
+                         f"{rate:.2f}it/s, loss={1 / step:.4f}, lr=0.0001]")
+        sys.stderr.flush()
+        if step % args.checkpointing_steps == 0 and step < total_steps:
+            save_checkpoint(args.output_dir, step, checkpoint_size,
+                            args.checkpoints_total_limit)
+        elif len(preempted) > 0:
+            save_checkpoint(args.output_dir, step, checkpoint_size,
+                            args.checkpoints_total_limit)
+        if len(preempted) > 0:
+            print(f"\nPreempted, saved checkpoint-{step}", flush=True)
+            return
+    sys.stderr.write("\n")
+    write_file(os.path.join(args.output_dir,
+               "pytorch_lora_weights.safetensors"), checkpoint_size // 3)
+    print("Stub training complete", flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,125 @@
+import collections
+import concurrent.futures
+import contextvars
+import threading
+import time
 import requests
 import config
 from requests.adapters import HTTPAdapter, Retry
 
+session = None
+session_pool_size = 0
+session_lock = threading.Lock()
+# Requests sent, by the job they were sent for. The job is the current_job
+# of the context the request is made in: threads working for a job run in a
+# copy of the job's context (in_job_context, JobThreadPoolExecutor).
+current_job = contextvars.ContextVar("current_job", default=None)
+job_requests = collections.Counter()
+stats_lock = threading.Lock()
 
-def get_api_session():
-    api = requests.Session()
-    api.headers.update({"x-api-key": config.api_key})
+
+def count_request(response, *args, **kwargs):
+    job_id = current_job.get()
+    if job_id is not None:
+        with stats_lock:
+            job_requests[job_id] += 1
+
+
+def in_job_context(function):
+    # Wraps a thread target to run in the context it was created in
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(function, *args, **kwargs)
+
+
+class JobThreadPoolExecutor(concurrent.futures.ThreadPoolExecutor):
+    # Runs every task in the context the pool was created in, whichever
+    # thread submits it (e.g. a watchdog observer)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.context = contextvars.copy_context()
+
+    def submit(self, function, *args, **kwargs):
+        return super().submit(self.context.copy().run, function, *args, **kwargs)
+
+
+def mount_adapter(api, pool_size):
     retries = Retry(
         total=3,
-        status_forcelist=[400, 401, 500, 502, 503, 504],
+        # A 401 is not retried: the token is stale, and the caller discards
+        # it and fetches a new one
+        status_forcelist=[400, 500, 502, 503, 504],
         status=3,
         backoff_factor=1,
         raise_on_status=False)
-    api.mount("https://", HTTPAdapter(max_retries=retries))
-    api.mount("http://", HTTPAdapter(max_retries=retries))
-    return api
+    # Size the connection pool to the number of threads sharing the session,
+    # otherwise connections beyond the pool size are thrown away after use
+    adapter = HTTPAdapter(max_retries=retries,
+                          pool_connections=4, pool_maxsize=pool_size)
+    api.mount("https://", adapter)
+    api.mount("http://", adapter)
+
+
+def get_api_session(pool_size=10):
+    # Every module shares one session, so connections are kept alive and
+    # reused across requests, threads and jobs
+    global session
+    global session_pool_size
+    with session_lock:
+        if session is None:
+            session = requests.Session()
+            session.headers.update({"x-api-key": config.api_key})
+            session.hooks["response"].append(count_request)
+        if pool_size > session_pool_size:
+            session_pool_size = max(pool_size, config.api_pool_size)
+            mount_adapter(session, session_pool_size)
+        return session
+
+
+def api_stats(job_id):
+    # Requests sent for the job, which stops counting, and connections
+    # opened by the shared session so far, which are shared by every job
+    with stats_lock:
+        requests_sent = job_requests.pop(job_id, 0)
+    connections = 0
+    if session is not None:
+        for adapter in session.adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                connections += pools[key].num_connections
+    return {"requests": requests_sent, "connections": connections}
+
+
+class TokenCache:
+    # Download and upload tokens are reused for `ttl` seconds. Tokens are
+    # cached per bucket and key, or per bucket when the API issues tokens that
+    # cover a whole bucket.
+    def __init__(self, ttl, scope):
+        self.ttl = ttl
+        self.scope = scope
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+    def cache_key(self, kind, bucket, key):
+        return (kind, bucket) if self.scope == "bucket" else (kind, bucket, key)
+
+    def get(self, kind, bucket, key, fetch):
+        if self.ttl <= 0:
+            return fetch()
+        cache_key = self.cache_key(kind, bucket, key)
+        with self.lock:
+            cached = self.tokens.get(cache_key)
+            if cached is not None and cached[1] > time.monotonic():
+                return cached[0]
+        token = fetch()
+        with self.lock:
+            self.tokens[cache_key] = (token, time.monotonic() + self.ttl)
+        return token
+
+    def discard(self, token):
+        # Called when the API rejects a token, so the next call fetches a new one
+        with self.lock:
+            for cache_key in [k for k, v in self.tokens.items() if v[0] == token]:
+                del self.tokens[cache_key]
+
+
+token_cache = TokenCache(config.token_cache_ttl, config.token_cache_scope)
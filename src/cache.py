@@ -0,0 +1,106 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import config
+from download import download_file, stat_object
+
+
+class DataCache:
+    # Keeps downloaded training data on the node between jobs. Entries are
+    # addressed by bucket/key plus the ETag and size of the object, and job
+    # directories are filled with hardlinks to them. Least recently used
+    # entries are evicted once the cache grows past `max_bytes`; entries that
+    # are still linked into a job directory are never evicted.
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.size = 0
+        if self.enabled():
+            os.makedirs(directory, exist_ok=True)
+            self.size = sum(entry.stat().st_size for entry in self.entries())
+
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def entries(self):
+        return [entry for entry in os.scandir(self.directory)
+                if entry.is_file() and not entry.name.endswith(".tmp")]
+
+    def entry_path(self, bucket, key, etag, size):
+        name = hashlib.sha256(
+            f"{bucket}/{key}\0{etag}\0{size}".encode()).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def fetch(self, bucket, key, filename, token=None, stat=None):
+        # Returns the size, and whether the cache had the object, as counts
+        # for BulkDownload to sum up. The object's stat (size and ETag) is
+        # reused for the download.
+        if not self.enabled():
+            return download_file(bucket, key, filename, token, stat)
+
+        if stat is None:
+            stat = stat_object(bucket, key, token)
+        if stat["etag"] is None and stat["size"] is None:
+            # Nothing to tell whether a cached copy is current
+            return download_file(bucket, key, filename, token, stat)
+
+        path = self.entry_path(bucket, key, stat["etag"], stat["size"])
+        hit = os.path.exists(path)
+        if hit:
+            # Mark the entry as recently used
+            os.utime(path)
+            logging.info(f"Using cached copy of {key} from {bucket}")
+        else:
+            download_path = f"{path}.{threading.get_ident()}.tmp"
+            try:
+                download_file(bucket, key, download_path, token, stat)
+            except Exception:
+                if os.path.exists(download_path):
+                    os.remove(download_path)
+                raise
+            os.replace(download_path, path)
+            self.add(path)
+        link_or_copy(path, filename)
+        evictions = self.evict()
+        return {"size": stat["size"] if stat["size"] is not None else os.path.getsize(filename),
+                "cache_hits": int(hit), "cache_misses": int(not hit), "cache_evictions": evictions}
+
+    def add(self, path):
+        # Accounts for an entry written into the cache directory
+        with self.lock:
+            self.size += os.path.getsize(path)
+
+    def evict(self):
+        # Returns the number of entries evicted
+        evictions = 0
+        with self.lock:
+            if self.size <= self.max_bytes:
+                return evictions
+            entries = sorted(self.entries(),
+                             key=lambda entry: entry.stat().st_mtime)
+            for entry in entries:
+                if self.size <= self.max_bytes:
+                    break
+                stat = entry.stat()
+                if stat.st_nlink > 1:
+                    continue
+                os.remove(entry.path)
+                self.size -= stat.st_size
+                evictions += 1
+        return evictions
+
+
+def link_or_copy(source, destination):
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        # The cache is on a different filesystem than the job directory
+        shutil.copyfile(source, destination)
+
+
+data_cache = DataCache(config.data_cache_dir, config.data_cache_max_bytes)
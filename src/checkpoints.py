@@ -1,5 +1,5 @@
-import sys
 import logging
+import threading
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 import time
@@ -7,38 +7,142 @@ import os
 import re
 import config
 import subprocess
-from upload import upload_file
-from download import download_file
+import zipfile
+import tarfile
+import io
+import shutil
+from api import in_job_context
+from upload import MultipartUploadWriter, UploadCanceled
+from download import open_remote_file
 from webhooks import send_progress_webhook
+import metrics
+import preemption
+import tracing
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-def zip_checkpoint(checkpoint_dir):
+
+# Archive formats for checkpoints, by file extension
+archive_extensions = {"zip": ".zip", "zip-store": ".zip",
+                      "tar": ".tar", "tar.zst": ".tar.zst"}
+
+
+def detect_archive_format(header):
+    # Detects the format of an archive from its first bytes
+    if header[:4] in (b"PK\x03\x04", b"PK\x05\x06"):
+        return "zip"
+    if header[:4] == b"\x28\xb5\x2f\xfd":
+        return "tar.zst"
+    if header[257:262] == b"ustar":
+        return "tar"
+    return None
+
+
+def archive_folder_name(archive_file):
+    for extension in (".tar.zst", ".tar", ".zip"):
+        if archive_file.endswith(extension):
+            return archive_file[:-len(extension)]
+    return os.path.splitext(archive_file)[0]
+
+
+def checkpoint_archive_format():
+    archive_format = config.checkpoint_archive_format
+    if archive_format not in archive_extensions:
+        logging.warning(
+            f"Unknown checkpoint archive format {archive_format}, using zip")
+        return "zip"
+    if archive_format == "tar.zst" and zstandard is None:
+        logging.warning(
+            "zstandard is not installed, archiving checkpoints as tar")
+        return "tar"
+    return archive_format
+
+
+def write_archive(output, archive_format, files):
+    # Writes (path, arcname) pairs to a non-seekable output
+    if archive_format in ("zip", "zip-store"):
+        compression = zipfile.ZIP_DEFLATED if archive_format == "zip" else zipfile.ZIP_STORED
+        with zipfile.ZipFile(output, "w", compression=compression) as archive:
+            for path, arcname in files:
+                archive.write(path, arcname=arcname)
+        return
+    if archive_format == "tar.zst":
+        compressor = zstandard.ZstdCompressor(
+            level=config.checkpoint_zstd_level, threads=config.checkpoint_zstd_threads)
+        with compressor.stream_writer(output, closefd=False) as compressed:
+            write_archive(compressed, "tar", files)
+        return
+    with tarfile.open(fileobj=output, mode="w|") as archive:
+        for path, arcname in files:
+            archive.add(path, arcname=arcname)
+
+
+@tracing.traced("checkpoints", size=lambda result, *args: result[1]["size"])
+def zip_checkpoint(checkpoint_dir, bucket, prefix, cancel=None):
     # Get the name of the rightmost directory
     base_dir = os.path.basename(checkpoint_dir)
 
-    # Construct the zip file name
-    zip_file_name = f"{base_dir}.zip"
+    # Construct the archive file name
+    archive_format = checkpoint_archive_format()
+    zip_file_name = f"{base_dir}{archive_extensions[archive_format]}"
+
+    logging.info(
+        f"Archiving and uploading checkpoint directory: {checkpoint_dir} as {zip_file_name}")
+
+    # Stream the archive straight into a multipart upload, so no archive is
+    # written to disk and compression overlaps with uploading. Paths are
+    # flattened the same way `zip -rj` did.
+    files = [(os.path.join(root, file), file)
+             for root, _, names in os.walk(checkpoint_dir) for file in sorted(names)]
+    start = time.monotonic()
+    with MultipartUploadWriter(bucket, f"{prefix}{zip_file_name}", cancel) as writer:
+        write_archive(writer, archive_format, files)
 
+    # Logged so the formats can be compared on a deployment's checkpoints
+    elapsed = time.monotonic() - start
+    raw_size = sum(os.path.getsize(path) for path, _ in files)
     logging.info(
-        f"Zipping and uploading checkpoint directory: {checkpoint_dir} as {zip_file_name}")
+        f"Checkpoint archive {zip_file_name} ({archive_format}): {raw_size / 1024 / 1024:.1f} MB -> {writer.tell() / 1024 / 1024:.1f} MB "
+        f"({writer.tell() / max(raw_size, 1):.1%}) in {elapsed:.2f}s ({raw_size / 1024 / 1024 / max(elapsed, 1e-6):.1f} MB/s)")
 
-    # Zip the contents of the rightmost directory
-    zip_command = ['zip', '-rj',
-                   f"{config.output_dir}/{zip_file_name}", f"{checkpoint_dir}"]
-    logging.info(f"Running command: {' '.join(zip_command)}")
-    subprocess.run(zip_command, check=True)
+    return zip_file_name, {"size": writer.tell(), "sha256": writer.sha256()}
 
-    return zip_file_name
+
+def extract_stream(stream, archive_format, output_folder):
+    # Extracts a tar or tar.zst archive from a stream, without seeking
+    if archive_format == "tar.zst":
+        if zstandard is None:
+            raise RuntimeError(
+                "zstandard is not installed, cannot extract a tar.zst checkpoint")
+        with zstandard.ZstdDecompressor().stream_reader(stream, closefd=False) as decompressed:
+            return extract_stream(decompressed, "tar", output_folder)
+    with tarfile.open(fileobj=stream, mode="r|") as archive:
+        if hasattr(tarfile, "data_filter"):
+            archive.extractall(output_folder, filter="data")
+        else:
+            archive.extractall(output_folder)
 
 
 def unzip_to_sibling_folder(zip_file):
-    # Get the name of the zip file without extension
-    zip_file_name = os.path.splitext(zip_file)[0]
+    # Get the name of the archive without extension
+    zip_file_name = archive_folder_name(zip_file)
 
-    # Create a folder with the same name as the zip file
+    # Create a folder with the same name as the archive
     output_folder = os.path.join(os.path.dirname(zip_file), zip_file_name)
     os.makedirs(output_folder, exist_ok=True)
 
+    with open(zip_file, "rb") as file:
+        file_format = detect_archive_format(file.read(512))
+    if file_format in ("tar", "tar.zst"):
+        with open(zip_file, "rb") as file:
+            extract_stream(file, file_format, output_folder)
+        logging.info(
+            f"Archive '{zip_file}' successfully extracted to '{output_folder}'.")
+        return
+
     # Construct the unzip command
     unzip_command = ['unzip', '-o', zip_file, '-d', output_folder]
 
@@ -51,64 +155,342 @@ def unzip_to_sibling_folder(zip_file):
         logging.info(f"Error: Failed to extract zip file '{zip_file}': {e}")
 
 
-def download_checkpoint(bucket, key):
-    output_file = f"{config.output_dir}/{key.split('/')[-1]}"
-    download_file(bucket, key, output_file)
+@tracing.traced("checkpoints", size=lambda result, *args: result)
+def download_checkpoint(bucket, key, output_dir):
+    # Returns the size of the downloaded archive. The archive format is
+    # detected from its content, so checkpoints archived in any format (or
+    # before the format was configurable) can be resumed from.
+    output_file = f"{output_dir}/{key.split('/')[-1]}"
+    output_folder = archive_folder_name(output_file)
+    with open_remote_file(bucket, key) as remote:
+        reader = io.BufferedReader(remote, config.download_chunk_size)
+        file_format = detect_archive_format(reader.peek(512))
+        if file_format in ("tar", "tar.zst"):
+            # Tar archives are extracted as they stream in. Whatever follows
+            # the end of the archive is read too, so all of it is hashed.
+            extract_stream(reader, file_format, output_folder)
+            while reader.read(config.download_chunk_size):
+                pass
+            logging.info(
+                f"Checkpoint {key} from {bucket} extracted to {output_folder} (sha256 {remote.verify()})")
+            return remote.size if remote.size is not None else remote.hashed
+
+        if remote.seekable():
+            # Extract straight from the ranged download, the archive is never
+            # written to disk. zipfile checks the CRC-32 of every file it
+            # extracts.
+            with zipfile.ZipFile(reader) as archive:
+                archive.extractall(output_folder)
+            logging.info(
+                f"Checkpoint {key} from {bucket} extracted to {output_folder} (sha256 {remote.verify()})")
+            return remote.size
+
+        with open(output_file, "wb") as file:
+            shutil.copyfileobj(reader, file, config.download_chunk_size)
+        logging.info(
+            f"Checkpoint {key} downloaded from {bucket} (sha256 {remote.verify()})")
+    size = os.path.getsize(output_file)
     unzip_to_sibling_folder(output_file)
     os.remove(output_file)
+    return size
 
 
-class CheckPointMonitor(FileSystemEventHandler):
-    def __init__(self, checkpoint_dir, bucket, prefix, job_id):
-        super().__init__()
-        self.checkpoint_dir = checkpoint_dir
+def files_open_for_writing(paths):
+    # Which of the paths some process has open for writing, from /proc. Where
+    # /proc is not available nothing is reported as open.
+    found = set()
+    try:
+        pids = [name for name in os.listdir("/proc") if name.isdigit()]
+    except OSError:
+        return found
+    for pid in pids:
+        try:
+            descriptors = os.listdir(f"/proc/{pid}/fd")
+        except OSError:
+            continue
+        for descriptor in descriptors:
+            try:
+                target = os.readlink(f"/proc/{pid}/fd/{descriptor}")
+                if target not in paths:
+                    continue
+                with open(f"/proc/{pid}/fdinfo/{descriptor}") as info:
+                    flags = next(int(line.split()[1], 8)
+                                 for line in info if line.startswith("flags:"))
+            except (OSError, StopIteration, ValueError):
+                continue
+            if flags & (os.O_WRONLY | os.O_RDWR):
+                found.add(target)
+    return found
+
+
+class CheckpointWrite:
+    # Follows the files of one checkpoint directory while they are written.
+    # Completion is decided from close-after-write and move events. Unless the
+    # expected files are configured, accelerate's `random_states_*.pkl`, which
+    # save_state writes last, marks the end of the checkpoint.
+    def __init__(self, directory, expected_files, timeout, on_complete):
+        self.directory = directory
+        self.expected_files = expected_files
+        self.on_complete = on_complete
+        self.writing = set()
+        self.written = set()
+        self.finished = False
+        self.lock = threading.Lock()
+        self.timer = threading.Timer(timeout, self.expire)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def file_event(self, path, closed):
+        name = os.path.relpath(path, self.directory)
+        with self.lock:
+            if self.finished:
+                return
+            if closed:
+                self.writing.discard(name)
+                self.written.add(name)
+            elif name not in self.written:
+                self.writing.add(name)
+        self.check()
+
+    def scan(self):
+        # Files written before the directory was being watched never get a
+        # close event. Whatever is on disk and no longer open for writing
+        # counts as written, files still open are waited for.
+        present = {os.path.realpath(os.path.join(root, file)): os.path.relpath(os.path.join(root, file), self.directory)
+                   for root, _, files in os.walk(self.directory) for file in files}
+        open_files = files_open_for_writing(present)
+        with self.lock:
+            if self.finished:
+                return
+            for path, name in present.items():
+                if path in open_files:
+                    if name not in self.written:
+                        self.writing.add(name)
+                elif name not in self.writing:
+                    self.written.add(name)
+        self.check()
+
+    def check(self):
+        with self.lock:
+            if self.finished or not self.is_complete():
+                return
+            self.finished = True
+        self.timer.cancel()
+        self.on_complete(self.directory)
+
+    def cancel(self):
+        with self.lock:
+            self.finished = True
+        self.timer.cancel()
+
+    def is_complete(self):
+        if len(self.writing) > 0:
+            return False
+        if len(self.expected_files) > 0:
+            return self.expected_files <= self.written
+        return any(re.match(r"random_states_\d+\.pkl$", name) for name in self.written)
+
+    def expire(self):
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+        # Events for files written before the directory was being watched are
+        # lost, so give the files on disk a last look
+        present = {os.path.relpath(os.path.join(root, file), self.directory)
+                   for root, _, files in os.walk(self.directory) for file in files}
+        self.written |= present
+        self.writing.clear()
+        if len(present) > 0 and self.is_complete():
+            logging.warning(
+                f"Checkpoint {self.directory} was not seen completing, uploading the files on disk.")
+            self.on_complete(self.directory)
+        else:
+            logging.error(
+                f"Checkpoint {self.directory} was not complete after {config.checkpoint_write_timeout} seconds, skipping it.")
+
+
+@tracing.traced("checkpoints")
+def snapshot_checkpoint(checkpoint_dir, staging_dir):
+    # Hardlink the files into the staging directory, which takes milliseconds
+    # and keeps them around if the checkpoint itself is deleted
+    snapshot_dir = os.path.join(staging_dir, os.path.basename(checkpoint_dir))
+    shutil.rmtree(snapshot_dir, ignore_errors=True)
+    for root, _, files in os.walk(checkpoint_dir):
+        target_dir = os.path.join(
+            snapshot_dir, os.path.relpath(root, checkpoint_dir))
+        os.makedirs(target_dir, exist_ok=True)
+        for file in files:
+            try:
+                os.link(os.path.join(root, file),
+                        os.path.join(target_dir, file))
+            except OSError:
+                shutil.copy2(os.path.join(root, file),
+                             os.path.join(target_dir, file))
+    return snapshot_dir
+
+
+class CheckpointUploader:
+    # Uploads checkpoints one at a time on a background thread. Checkpoints are
+    # snapshotted as soon as they are complete, since training may delete them
+    # (--checkpoints_total_limit) while they are waiting or uploading. A
+    # checkpoint still waiting when a newer one arrives is dropped, only the
+    # newest one is worth the bandwidth. Once prioritized (on preemption), a
+    # new checkpoint also cancels the upload in progress.
+    def __init__(self, staging_dir, bucket, prefix, job_id):
+        self.staging_dir = staging_dir
         self.bucket = bucket
         self.prefix = prefix
         self.job_id = job_id
+        self.pending = None
+        self.stopping = False
+        self.uploading = False
+        self.priority = False
+        self.submitted = 0
+        self.cancel = threading.Event()
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=in_job_context(self.run))
+        self.thread.start()
+
+    def submit(self, checkpoint_dir):
+        try:
+            snapshot_dir = snapshot_checkpoint(
+                checkpoint_dir, self.staging_dir)
+        except OSError as e:
+            logging.error(f"Error: Failed to snapshot {checkpoint_dir}: {e}")
+            return
+        with self.condition:
+            if self.pending is not None:
+                logging.info(
+                    f"Skipping upload of {os.path.basename(self.pending)}, superseded by {os.path.basename(snapshot_dir)}")
+                shutil.rmtree(self.pending, ignore_errors=True)
+            if self.priority and self.uploading:
+                logging.info(
+                    f"Canceling the upload in progress for {os.path.basename(snapshot_dir)}")
+                self.cancel.set()
+            self.pending = snapshot_dir
+            self.submitted += 1
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.stopping:
+                    self.condition.wait()
+                if self.pending is None:
+                    return
+                snapshot_dir = self.pending
+                self.pending = None
+                self.uploading = True
+            try:
+                with metrics.phase(self.job_id, "checkpoint_upload") as record:
+                    zip_file_name, checksum = zip_checkpoint(
+                        snapshot_dir, self.bucket, self.prefix, self.cancel)
+                    record["bytes"] = checksum["size"]
+                send_progress_webhook(
+                    self.bucket, f"{self.prefix}{zip_file_name}", self.job_id, checksum)
+            except UploadCanceled:
+                logging.info(f"Canceled upload of {snapshot_dir}")
+            except Exception as e:
+                logging.error(
+                    f"Error: Failed to upload checkpoint {snapshot_dir}: {e}")
+            finally:
+                shutil.rmtree(snapshot_dir, ignore_errors=True)
+                with self.condition:
+                    self.uploading = False
+                    self.cancel.clear()
+                    self.condition.notify_all()
+
+    def prioritize(self):
+        with self.condition:
+            self.priority = True
+
+    def idle(self):
+        return self.pending is None and not self.uploading
+
+    def wait(self, predicate, deadline):
+        # Waits until predicate() holds or the deadline (monotonic time) has
+        # passed, returns whether it holds. The predicate is checked on every
+        # change and at least once a second.
+        with self.condition:
+            while not predicate():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(min(remaining, 1))
+            return True
+
+    def stop(self):
+        # Finishes the upload in progress and the one waiting, if any
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.thread.join()
+
+
+class CheckPointMonitor(FileSystemEventHandler):
+    def __init__(self, checkpoint_dir, uploader):
+        super().__init__()
+        self.checkpoint_dir = checkpoint_dir
+        self.uploader = uploader
+        self.checkpoints = {}
 
     def on_created(self, event):
-        if event.is_directory and event.src_path.startswith(self.checkpoint_dir) and re.search(r"checkpoint-\d+/?$", event.src_path):
+        if event.is_directory and os.path.dirname(event.src_path.rstrip("/")) == self.checkpoint_dir.rstrip("/") and re.search(r"checkpoint-\d+/?$", event.src_path):
             logging.info(
                 f"New checkpoint directory created: {event.src_path}")
-            self.wait_for_write_completion(event.src_path)
-            zip_file_name = zip_checkpoint(event.src_path)
-            upload_file(f"{config.output_dir}/{zip_file_name}", self.bucket,
-                        f"{self.prefix}{zip_file_name}")
-            send_progress_webhook(
-                self.bucket, f"{self.prefix}{zip_file_name}", self.job_id)
-            os.remove(f"{config.output_dir}/{zip_file_name}")
-
-    def wait_for_write_completion(self, directory):
-        logging.info(f"Waiting for write operations to stop in {directory}...")
-        expected_files = {"pytorch_lora_weights.safetensors", "optimizer.bin",
-                          "scheduler.bin", "scaler.pt", "random_states_0.pkl"}
-        found_files = set()
-        while not found_files == expected_files:
-            time.sleep(1)
-            try:
-                if os.path.exists(os.path.join(directory, "sampler.bin")):
-                    expected_files.add("sampler.bin")
-                # Check if all expected files are present and have non-zero size,
-                # and have no write operations in progress
-                for file in expected_files:
-                    file_path = os.path.join(directory, file)
-                    if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
-                        mod_time = os.path.getmtime(file_path)
-                        if (time.time() - mod_time) > .5 and file not in found_files:
-                            logging.info(
-                                f"File {file_path} has stopped writing.")
-                            found_files.add(file)
-                        elif (time.time() - mod_time) <= .5 and file not in found_files:
-                            logging.info(
-                                f"File {file_path} is still being written.")
+            directory = event.src_path.rstrip("/")
+            checkpoint = CheckpointWrite(
+                directory, config.checkpoint_expected_files, config.checkpoint_write_timeout, self.checkpoint_complete)
+            self.checkpoints[directory] = checkpoint
+            checkpoint.scan()
+        elif not event.is_directory:
+            # Files that appeared before the new directory was being watched
+            # only get a synthetic created event, never a close, so the
+            # directory is looked at on disk
+            for directory, checkpoint in list(self.checkpoints.items()):
+                if event.src_path.startswith(directory + os.sep):
+                    checkpoint.scan()
 
-            except Exception as e:
-                logging.error(f"Error: {e}")
-                sys.exit(1)
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.file_event(event.src_path, closed=False)
+
+    def on_closed(self, event):
+        if not event.is_directory:
+            self.file_event(event.src_path, closed=True)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.file_event(event.dest_path, closed=True)
+
+    def file_event(self, path, closed):
+        for directory, checkpoint in list(self.checkpoints.items()):
+            if path.startswith(directory + os.sep):
+                checkpoint.file_event(path, closed)
+
+    def checkpoint_complete(self, directory):
+        tracing.instant("checkpoint_complete", "checkpoints",
+                        directory=directory)
+        self.checkpoints.pop(directory, None)
+        logging.info(f"Checkpoint {directory} has been written.")
+        self.uploader.submit(directory)
+
+    def cancel(self):
+        # Checkpoints still being followed when the job ends are dropped, so
+        # their timers cannot fire against the next job's directories
+        for checkpoint in list(self.checkpoints.values()):
+            checkpoint.cancel()
+        self.checkpoints.clear()
 
 
 def monitor_checkpoint_directories(directory, bucket, prefix, job_id, stop_signal):
-    event_handler = CheckPointMonitor(directory, bucket, prefix, job_id)
+    # Snapshots live next to the checkpoints so they can be hardlinked. The
+    # leading dot keeps them out of the training script's checkpoint listing.
+    uploader = CheckpointUploader(os.path.join(
+        directory, ".checkpoint-staging"), bucket, prefix, job_id)
+    preemption.track(job_id, uploader=uploader)
+    event_handler = CheckPointMonitor(directory, uploader)
     observer = Observer()
     observer.schedule(event_handler, directory, recursive=True)
     observer.start()
@@ -117,7 +499,15 @@ def monitor_checkpoint_directories(directory, bucket, prefix, job_id, stop_signa
     try:
         while not stop_signal.is_set():
             time.sleep(1)
+        if preemption.preempting.is_set():
+            # Preempted training exits right after writing its checkpoint,
+            # let the observer see the write through
+            time.sleep(1)
+            while len(event_handler.checkpoints) > 0 and time.monotonic() < preemption.deadline:
+                time.sleep(0.2)
         observer.stop()
     except KeyboardInterrupt:
         observer.stop()
     observer.join()
+    event_handler.cancel()
+    uploader.stop()
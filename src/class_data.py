@@ -1,34 +1,101 @@
 import logging
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
+import concurrent.futures
+import threading
 import time
 import os
-from upload import upload_file
+import zipfile
+import config
+import tracing
+from api import JobThreadPoolExecutor
+from upload import upload_file, MultipartUploadWriter
+
+
+class ClassDataUploader:
+    # Uploads generated class images from a bounded thread pool, so generation
+    # never waits on the network. With a batch size set, images are collected
+    # into uncompressed zip archives of that many files and each archive is
+    # uploaded as one object.
+    def __init__(self, bucket, prefix, workers, batch_size):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.executor = JobThreadPoolExecutor(workers)
+        self.futures = []
+        self.batch = []
+        self.lock = threading.Lock()
+
+    def submit(self, file_path):
+        with self.lock:
+            if self.batch_size <= 0:
+                self.futures.append(
+                    self.executor.submit(self.upload_image, file_path))
+                return
+            self.batch.append(file_path)
+            if len(self.batch) >= self.batch_size:
+                self.submit_batch()
+
+    def submit_batch(self):
+        files, self.batch = self.batch, []
+        self.futures.append(self.executor.submit(self.upload_batch, files))
+
+    @tracing.traced("class_data")
+    def upload_image(self, file_path):
+        upload_file(file_path, self.bucket,
+                    f"{self.prefix}{file_path.split('/')[-1]}")
+
+    @tracing.traced("class_data")
+    def upload_batch(self, files):
+        # Generated file names are unique, so the first one names the batch
+        first_name = os.path.splitext(os.path.basename(files[0]))[0]
+        key = f"{self.prefix}class-batch-{first_name}.zip"
+        with MultipartUploadWriter(self.bucket, key) as writer:
+            with zipfile.ZipFile(writer, "w", compression=zipfile.ZIP_STORED) as archive:
+                for file_path in files:
+                    archive.write(
+                        file_path, arcname=os.path.basename(file_path))
+        logging.info(f"Uploaded {len(files)} class images as {key}")
+
+    def close(self):
+        with self.lock:
+            if len(self.batch) > 0:
+                self.submit_batch()
+        concurrent.futures.wait(self.futures)
+        for future in self.futures:
+            if future.exception() is not None:
+                logging.error(
+                    f"Error: Failed to upload class data: {future.exception()}")
+        self.executor.shutdown()
 
 
 class ClassDataMonitor(FileSystemEventHandler):
-    def __init__(self, class_data_dir, bucket, prefix):
+    def __init__(self, class_data_dir, uploader):
         super().__init__()
         self.class_data_dir = class_data_dir
-        self.bucket = bucket
-        self.prefix = prefix
+        self.uploader = uploader
 
-    def on_created(self, event):
+    # A file is only handed off once it has been closed after writing (or
+    # moved into place), so partially written images are never uploaded
+    def on_closed(self, event):
         if not event.is_directory and event.src_path.startswith(self.class_data_dir):
             print(f"File {event.src_path} has been created!")
-            self.wait_for_write_completion(event.src_path)
-            upload_file(event.src_path, self.bucket,
-                        f"{self.prefix}{event.src_path.split('/')[-1]}")
+            tracing.instant("class_image_written", "class_data",
+                            path=event.src_path)
+            self.uploader.submit(event.src_path)
 
-    def wait_for_write_completion(self, file_path):
-        while True:
-            if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
-                return
-            time.sleep(.1)
+    def on_moved(self, event):
+        if not event.is_directory and event.dest_path.startswith(self.class_data_dir):
+            print(f"File {event.dest_path} has been created!")
+            tracing.instant("class_image_written", "class_data",
+                            path=event.dest_path)
+            self.uploader.submit(event.dest_path)
 
 
 def monitor_class_data(directory, bucket, prefix, stop_signal):
-    event_handler = ClassDataMonitor(directory, bucket, prefix)
+    uploader = ClassDataUploader(
+        bucket, prefix, config.class_data_upload_workers, config.class_data_batch_size)
+    event_handler = ClassDataMonitor(directory, uploader)
     observer = Observer()
     observer.schedule(event_handler, directory, recursive=True)
     observer.start()
@@ -41,3 +108,4 @@ def monitor_class_data(directory, bucket, prefix, stop_signal):
     except KeyboardInterrupt:
         observer.stop()
     observer.join()
+    uploader.close()
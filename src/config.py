@@ -1,4 +1,5 @@
 import os
+import signal
 
 log_level = os.getenv("LOG_LEVEL", "INFO").upper()
 
@@ -15,9 +16,70 @@ api_key = os.getenv("API_KEY", None)
 if api_base_url is None or api_key is None:
     raise ValueError("API_URL and API_KEY must be set.")
 
+# Directory where in-progress multipart uploads are recorded so failed ones
+# can be resumed. Keep it outside of the directories that are cleared between
+# jobs.
+upload_state_dir = os.getenv("UPLOAD_STATE_DIR", "/upload_state")
+
+# Training data is kept here between jobs, up to the given size. Set the size
+# to 0 to disable the cache.
+data_cache_dir = os.getenv("DATA_CACHE_DIR", "/data_cache")
+data_cache_max_bytes = int(
+    float(os.getenv("DATA_CACHE_MAX_GB", "20")) * 1024 * 1024 * 1024)
+
+# Resize instance images to the job's resolution before training, in a pool
+# of worker processes, keeping the results in a cache of the given size
+preprocess_images = os.getenv("PREPROCESS_IMAGES", "false").lower() == "true"
+preprocess_workers = int(os.getenv("PREPROCESS_WORKERS", str(os.cpu_count())))
+preprocess_quality = int(os.getenv("PREPROCESS_QUALITY", "95"))
+preprocess_cache_dir = os.getenv("PREPROCESS_CACHE_DIR", "/preprocess_cache")
+preprocess_cache_max_bytes = int(
+    float(os.getenv("PREPROCESS_CACHE_MAX_GB", "2")) * 1024 * 1024 * 1024)
+
+# Idle nodes poll for work with an interval that doubles from the minimum up
+# to the maximum, with jitter. With a long poll timeout above 0, the API is
+# asked to hold each poll until work is available, up to that many seconds.
+work_poll_min_seconds = float(os.getenv("WORK_POLL_MIN_SECONDS", "1"))
+work_poll_max_seconds = float(os.getenv("WORK_POLL_MAX_SECONDS", "30"))
+work_long_poll_seconds = int(os.getenv("WORK_LONG_POLL_SECONDS", "0"))
+
+# Base models named by jobs are downloaded from the Hugging Face Hub into this
+# directory and kept up to the given size (0 disables the cache), unless the
+# Hub's own cache has them already (e.g. baked into the image). Models in
+# MODEL_PREWARM and MODEL_PINNED are fetched at startup, pinned ones are never
+# evicted. Only what from_pretrained loads is downloaded: configs, tokenizers
+# and one set of weights per component, safetensors over .bin and no fp16 or
+# other variants. Files matching the ignore patterns are not downloaded.
+model_cache_dir = os.getenv("MODEL_CACHE_DIR", "/model_cache")
+model_cache_max_bytes = int(
+    float(os.getenv("MODEL_CACHE_MAX_GB", "50")) * 1024 * 1024 * 1024)
+model_prewarm = [name.strip() for name in os.getenv(
+    "MODEL_PREWARM", "").split(",") if name.strip()]
+model_pinned = [name.strip() for name in os.getenv(
+    "MODEL_PINNED", "").split(",") if name.strip()]
+model_ignore_patterns = [pattern.strip() for pattern in os.getenv(
+    "MODEL_IGNORE_PATTERNS", "*.msgpack,*.onnx,*.onnx_data,*.h5,*.ot,*.ckpt,flax_model*,tf_model*,rust_model*,*openvino*").split(",") if pattern.strip()]
+
+# Number of upcoming jobs to claim and download while the current job trains,
+# and how much disk their staged data may use. A depth of 0 disables it.
+prefetch_depth = int(os.getenv("PREFETCH_DEPTH", "0"))
+prefetch_dir = os.getenv("PREFETCH_DIR", "/prefetch")
+prefetch_max_bytes = int(
+    float(os.getenv("PREFETCH_MAX_GB", "20")) * 1024 * 1024 * 1024)
+
+# Directories of finished jobs are renamed into a .trash directory next to
+# them and deleted in the background. Data for the next job is only
+# downloaded once the disk has DISK_MIN_FREE_GB free (or nothing is left to
+# delete), prefetching needs PREFETCH_MIN_FREE_GB.
+disk_min_free_bytes = int(
+    float(os.getenv("DISK_MIN_FREE_GB", "5")) * 1024 * 1024 * 1024)
+prefetch_min_free_bytes = int(
+    float(os.getenv("PREFETCH_MIN_FREE_GB", "20")) * 1024 * 1024 * 1024)
+
 os.makedirs(instance_dir, exist_ok=True)
 os.makedirs(class_dir, exist_ok=True)
 os.makedirs(output_dir, exist_ok=True)
+os.makedirs(upload_state_dir, exist_ok=True)
 
 # Salad Machine and Container Group IDs
 salad_machine_id = os.getenv("SALAD_MACHINE_ID", None)
@@ -29,4 +91,119 @@ salad_project_name = os.getenv("SALAD_PROJECT_NAME", None)
 
 heartbeat_interval = int(os.getenv("HEARTBEAT_INTERVAL", "30"))
 
+# Number of jobs run at the same time, each on its own share of the GPUs.
+# "auto" runs one job per GPU. GPU_DEVICES overrides the GPUs found with
+# nvidia-smi.
+gpu_slots = os.getenv("GPU_SLOTS", "1")
+gpu_slots = 0 if gpu_slots == "auto" else int(gpu_slots)
+gpu_devices = [device.strip() for device in os.getenv("GPU_DEVICES", "").split(",")
+               if device.strip()] or None
+
+# Command that runs the job's training script, and a script to run instead of
+# the job's (e.g. bench/stub_train.py to test on a machine without GPUs)
+training_launcher = os.getenv("TRAINING_LAUNCHER", "accelerate launch")
+training_script = os.getenv("TRAINING_SCRIPT", None)
+
+# Run the training script in a training daemon that stays up between jobs,
+# so Python, torch and the base model are loaded once per slot rather than
+# once per job. The "plain" backend keeps only the imported libraries, each
+# job loads its models itself. The "diffusers" backend also keeps the models
+# the script loads resident; it is experimental, not yet tested on GPUs, and
+# only used when named here. The "stub" backend goes with
+# bench/stub_train.py. The daemon is a single process, slots with several
+# GPUs still use TRAINING_LAUNCHER.
+training_daemon = os.getenv("TRAINING_DAEMON", "false").lower() == "true"
+training_daemon_backend = os.getenv("TRAINING_DAEMON_BACKEND", "plain")
+
 wandb_api_key = os.getenv("WANDB_API_KEY", None)
+
+# Port for the Prometheus metrics endpoint (0 disables it), and a file to
+# append one JSON line per job phase to
+metrics_port = int(os.getenv("METRICS_PORT", "0"))
+metrics_log = os.getenv("METRICS_LOG", None)
+
+# Directory to write a Chrome trace of every job to, with spans for phases and
+# I/O calls on every thread (unset disables tracing). With TRACE_UPLOAD the
+# trace is uploaded next to the job's checkpoints. At most TRACE_MAX_EVENTS
+# spans are held in memory.
+trace_dir = os.getenv("TRACE_DIR", None)
+trace_upload = os.getenv("TRACE_UPLOAD", "false").lower() == "true"
+trace_max_events = int(os.getenv("TRACE_MAX_EVENTS", "1000000"))
+
+# A checkpoint is uploaded once all of these files have been written. When
+# empty, completion is inferred from the files accelerate's save_state writes.
+checkpoint_expected_files = {name.strip() for name in os.getenv(
+    "CHECKPOINT_EXPECTED_FILES", "").split(",") if name.strip()}
+# Give up on a checkpoint that is still incomplete after this many seconds
+checkpoint_write_timeout = int(os.getenv("CHECKPOINT_WRITE_TIMEOUT", "600"))
+
+# Format of checkpoint archives: zip (deflate), zip-store (no compression),
+# tar, or tar.zst (zstd at the given level on the given number of threads,
+# needs the zstandard package). Resumed checkpoints are detected by content.
+checkpoint_archive_format = os.getenv("CHECKPOINT_ARCHIVE_FORMAT", "zip")
+checkpoint_zstd_level = int(os.getenv("CHECKPOINT_ZSTD_LEVEL", "3"))
+checkpoint_zstd_threads = int(os.getenv("CHECKPOINT_ZSTD_THREADS", "2"))
+
+# Threads uploading generated class images. With a batch size above 0, class
+# images are uploaded as one zip archive per that many images.
+class_data_upload_workers = int(os.getenv("CLASS_DATA_UPLOAD_WORKERS", "8"))
+class_data_batch_size = int(os.getenv("CLASS_DATA_BATCH_SIZE", "0"))
+
+# Large downloads are fetched as parallel Range requests of this size
+download_chunk_size = int(
+    os.getenv("DOWNLOAD_CHUNK_SIZE_MB", "8")) * 1024 * 1024
+download_concurrency = int(os.getenv("DOWNLOAD_CONCURRENCY", "8"))
+# Job data is downloaded this many files at a time to start with, tuned from
+# throughput up to the maximum
+download_files_initial_concurrency = int(
+    os.getenv("DOWNLOAD_FILES_INITIAL_CONCURRENCY", "16"))
+download_files_max_concurrency = int(
+    os.getenv("DOWNLOAD_FILES_MAX_CONCURRENCY", "64"))
+
+# Connections kept alive by the shared API session, enough for every download
+# thread and the upload parts in flight
+api_pool_size = int(os.getenv("API_POOL_SIZE", str(10 * download_concurrency)))
+
+# Download and upload tokens are reused for this many seconds (0 disables
+# reuse), per key or per bucket depending on what the API's tokens cover
+token_cache_ttl = int(os.getenv("TOKEN_CACHE_TTL", "60"))
+token_cache_scope = os.getenv("TOKEN_CACHE_SCOPE", "key")
+
+# Attempts at a multipart upload before it is given up. Each retry only sends
+# the parts that have not made it yet.
+upload_attempts = max(1, int(os.getenv("UPLOAD_ATTEMPTS", "3")))
+# Upper bound on part buffers a single upload may hold in memory at once
+upload_max_inflight_bytes = int(
+    os.getenv("UPLOAD_MAX_INFLIGHT_MB", "100")) * 1024 * 1024
+# Files up to this size are sent in one request instead of a multipart upload
+upload_single_request_max_bytes = int(
+    float(os.getenv("UPLOAD_SINGLE_REQUEST_MAX_MB", "5")) * 1024 * 1024)
+# Larger files use bigger parts to stay under this many parts
+upload_max_parts = int(os.getenv("UPLOAD_MAX_PARTS", "1000"))
+# Parts in flight when an upload starts, tuned from throughput from there on
+upload_initial_concurrency = int(os.getenv("UPLOAD_INITIAL_CONCURRENCY", "4"))
+# Send a Content-MD5 header with every upload request, so corrupted bodies are
+# rejected by the storage backend
+upload_content_md5 = os.getenv(
+    "UPLOAD_CONTENT_MD5", "true").lower() == "true"
+
+# Training progress is parsed from the training script's output and sent with
+# the heartbeat. A node training below this fraction of the fleet's baseline
+# it/s is flagged as slow (a baseline of 0 disables the check; jobs can carry
+# their own baseline_it_per_second). Only judged after the first min steps.
+training_baseline_it_per_second = float(
+    os.getenv("TRAINING_BASELINE_IT_PER_SECOND", "0"))
+slow_node_fraction = float(os.getenv("SLOW_NODE_FRACTION", "0.5"))
+slow_node_min_steps = int(os.getenv("SLOW_NODE_MIN_STEPS", "20"))
+
+# On SIGTERM (e.g. the node is being preempted) the worker uploads the next
+# checkpoint training writes before it exits. Training scripts that write a
+# checkpoint on a signal (e.g. SIGUSR1) and exit can name it in
+# PREEMPT_SIGNAL, to be sent right away. Unset, training is left running to
+# its next checkpoint: the default action of most signals would kill it. The
+# worker only waits for it when training's progress says it comes within the
+# grace period. All of it has to fit in the grace period the platform gives
+# between SIGTERM and killing the container.
+preempt_grace_seconds = float(os.getenv("PREEMPT_GRACE_SECONDS", "60"))
+preempt_signal = signal.Signals[os.environ["PREEMPT_SIGNAL"]] if os.getenv(
+    "PREEMPT_SIGNAL") else None
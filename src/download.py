@@ -1,11 +1,30 @@
-from api import get_api_session
+from api import JobThreadPoolExecutor, get_api_session, token_cache
+from integrity import IntegrityError, etag_md5, verify_md5
+from upload import AdaptiveConcurrency
 import config
+import collections
 import concurrent.futures
+import hashlib
+import io
 import logging
+import math
+import os
+import shutil
+import threading
+import time
+import tracing
 
+# Extended attribute holding the ETag of the object a file was downloaded from
+etag_attribute = "user.etag"
 
-def download_file(bucket, key, filename):
-    api = get_api_session()
+
+def get_download_token(api, bucket, key):
+    return token_cache.get("download", bucket, key,
+                           lambda: fetch_download_token(api, bucket, key))
+
+
+@tracing.traced("download")
+def fetch_download_token(api, bucket, key):
     token_url = f"{config.api_base_url}/download/token"
     download_resp = api.get(
         token_url, params={"bucket": bucket, "key": key})
@@ -16,32 +35,388 @@ def download_file(bucket, key, filename):
         logging.error(f"Error: {e.response.text}")
         raise e
 
-    download_token = download_resp.json()["token"]
+    return download_resp.json()["token"]
 
-    url = f"{config.api_base_url}/download/{bucket}/{key}"
+
+def request_range(api, url, token, start, end, stream=False):
     try:
-        response = api.get(url, stream=True, headers={
-            'x-download-token': download_token})
+        response = api.get(url, stream=stream, headers={
+            'x-download-token': token, 'Range': f"bytes={start}-{end}"})
     except Exception as e:
-        logging.error(f"Error: Failed to download {key} from {bucket}: {e}")
+        logging.error(f"Error: Failed to download {url}: {e}")
         raise e
-    else:
-        try:
-            response.raise_for_status()
-        except Exception as e:
-            logging.error(e.response.text)
-            raise e
+    # An empty object cannot satisfy any range, but is not an error
+    if response.status_code == 416 and object_size(response) == 0:
+        return response
+    if response.status_code in (401, 403):
+        token_cache.discard(token)
+    try:
+        response.raise_for_status()
+    except Exception as e:
+        logging.error(e.response.text)
+        raise e
+    return response
+
+
+@tracing.traced("download", size=lambda result, *args: len(result))
+def fetch_range(api, url, token, start, end):
+    response = request_range(api, url, token, start, end)
+    if response.status_code != 206:
+        raise ValueError(
+            f"Range request for {url} returned status {response.status_code}")
+    return check_range(url, response.content, start, end)
+
+
+def check_range(url, data, start, end):
+    # A body cut short would end the copy early, and leave the rest of a
+    # preallocated file as zeros
+    if len(data) != end - start + 1:
+        raise IntegrityError(
+            f"Range {start}-{end} of {url} returned {len(data)} bytes instead of {end - start + 1}")
+    return data
+
+
+def object_size(response):
+    # The full size of the object is only known when the server answered the
+    # Range request with a partial response
+    if response.status_code not in (206, 416):
+        return None
+    total = response.headers.get("Content-Range", "").rpartition("/")[2]
+    return int(total) if total.isdigit() else None
+
+
+class RemoteFile(io.RawIOBase):
+    # Read-only file object over an object in the download API. If the server
+    # supports Range requests the object is fetched in chunks, with the chunks
+    # after the read position downloading in parallel, and the file is seekable.
+    # Otherwise it falls back to reading the plain response stream.
+    #
+    # The content is hashed as it is consumed: chunks are hashed in order once
+    # the read position has moved past them, so a sequential reader (or a zip
+    # extraction, which only jumps ahead to the central directory first) gets
+    # the SHA-256 of the object without a second pass. The MD5 is computed as
+    # well when the ETag is one to check it against.
+    #
+    # Without a first response, the size and ETag come from a stat_object of
+    # the object (`stat`) and every chunk is requested as it is needed.
+    def __init__(self, api, url, token, first_response, chunk_size, concurrency, stat=None):
+        super().__init__()
+        self.api = api
+        self.url = url
+        self.token = token
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        if first_response is not None:
+            self.size = object_size(first_response)
+            self.etag = first_response.headers.get("ETag")
         else:
-            with open(filename, "wb") as file:
-                for chunk in response.iter_content(chunk_size=8192):
-                    file.write(chunk)
-            logging.info(f"Downloaded {key} from {bucket} to {filename}")
-
-
-def concurrently_download(files):
-    with concurrent.futures.ThreadPoolExecutor(10) as executor:
-        futures = [executor.submit(
-            download_file, file["bucket"], file["key"], file["filename"]) for file in files]
-        concurrent.futures.wait(futures)
-        for future in futures:
-            future.result()
+            self.size = stat["size"]
+            self.etag = stat["etag"]
+        self.position = 0
+        self.sha256 = hashlib.sha256()
+        self.md5 = hashlib.md5() if etag_md5(self.etag) is not None else None
+        self.hashed = 0
+        if self.size is None:
+            self.response = first_response
+            self.response.raw.decode_content = True
+        else:
+            self.response = None
+            self.chunks = {}
+            if first_response is not None and self.size > 0:
+                first_chunk = concurrent.futures.Future()
+                first_chunk.set_result(check_range(
+                    url, first_response.content, 0, min(chunk_size, self.size) - 1))
+                self.chunks[0] = first_chunk
+            self.chunk_count = math.ceil(self.size / chunk_size)
+            self.executor = JobThreadPoolExecutor(concurrency)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return self.size is not None
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if not self.seekable():
+            raise io.UnsupportedOperation("seek")
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        return self.position
+
+    def readinto(self, buffer):
+        if self.response is not None:
+            data = self.response.raw.read(len(buffer))
+            buffer[:len(data)] = data
+            self.position += len(data)
+            self.hash(data)
+            return len(data)
+
+        if self.position >= self.size:
+            return 0
+        index = self.position // self.chunk_size
+        data = self._chunk(index).result()
+        offset = self.position - index * self.chunk_size
+        count = min(len(buffer), len(data) - offset)
+        with memoryview(data) as view:
+            buffer[:count] = view[offset:offset + count]
+        self.position += count
+        return count
+
+    def hash(self, data):
+        self.sha256.update(data)
+        if self.md5 is not None:
+            self.md5.update(data)
+        self.hashed += len(data)
+
+    def _hash_chunks(self, end):
+        # Hashes the downloaded chunks from the last hashed one up to `end`,
+        # stopping at the first one that was skipped or is not done
+        while self.hashed < end:
+            chunk = self.chunks.get(self.hashed // self.chunk_size)
+            if chunk is None or not chunk.done() or chunk.cancelled() or chunk.exception() is not None:
+                return
+            self.hash(chunk.result())
+
+    def _chunk(self, index):
+        self._hash_chunks(index * self.chunk_size)
+        # Chunks behind the read position are not needed anymore
+        for stale in [i for i in self.chunks if i < index]:
+            self.chunks.pop(stale).cancel()
+        # Keep the next chunks downloading while this one is consumed
+        for ahead in range(index, min(index + self.concurrency, self.chunk_count)):
+            if ahead not in self.chunks:
+                start = ahead * self.chunk_size
+                end = min(start + self.chunk_size, self.size) - 1
+                self.chunks[ahead] = self.executor.submit(
+                    fetch_range, self.api, self.url, self.token, start, end)
+        return self.chunks[index]
+
+    def hexdigest(self):
+        # The SHA-256 of the object, if all of it has been read
+        if self.size is not None and self.size > 0 and self.chunks:
+            self._hash_chunks(self.size)
+        if self.size is not None and self.hashed != self.size:
+            return None
+        return self.sha256.hexdigest()
+
+    def verify(self):
+        # Checks the content read against the ETag, when the ETag is an MD5.
+        # Returns the SHA-256, or None if the object was not read in full.
+        sha256 = self.hexdigest()
+        if sha256 is not None and self.md5 is not None:
+            verify_md5(self.etag, self.md5.hexdigest(), self.url)
+        return sha256
+
+    def close(self):
+        if not self.closed:
+            if self.response is not None:
+                self.response.close()
+            else:
+                self.executor.shutdown(cancel_futures=True)
+                self.chunks.clear()
+        super().close()
+
+
+def open_remote_file(bucket, key, token=None, stat=None):
+    # stat, the result of a stat_object just done, saves the first request
+    api = get_api_session(pool_size=config.download_concurrency)
+    download_token = token or get_download_token(api, bucket, key)
+
+    url = f"{config.api_base_url}/download/{bucket}/{key}"
+    if stat is not None and stat["size"] is not None:
+        return RemoteFile(api, url, download_token, None,
+                          config.download_chunk_size, config.download_concurrency, stat)
+    # Ask for the first chunk only. A server that supports ranges tells us the
+    # full size of the object, anything else just sends all of it.
+    response = request_range(
+        api, url, download_token, 0, config.download_chunk_size - 1, stream=True)
+    return RemoteFile(api, url, download_token, response,
+                      config.download_chunk_size, config.download_concurrency)
+
+
+@tracing.traced("download")
+def stat_object(bucket, key, token=None):
+    api = get_api_session()
+    download_token = token or get_download_token(api, bucket, key)
+
+    url = f"{config.api_base_url}/download/{bucket}/{key}"
+    # A one byte range is the cheapest way to learn the size and ETag. If the
+    # server ignores the range the body is dropped without being read.
+    with request_range(api, url, download_token, 0, 0, stream=True) as response:
+        size = object_size(response)
+        if size is None and response.status_code == 200 and "Content-Length" in response.headers:
+            size = int(response.headers["Content-Length"])
+        return {"size": size, "etag": response.headers.get("ETag")}
+
+
+def preallocate(file, size):
+    try:
+        os.posix_fallocate(file.fileno(), 0, size)
+    except (AttributeError, OSError):
+        pass
+
+
+def record_etag(filename, etag):
+    # Lets a later download tell the file is current without reading it
+    if etag is None:
+        return
+    try:
+        os.setxattr(filename, etag_attribute, etag.encode())
+    except (AttributeError, OSError):
+        pass
+
+
+def forget_etag(filename):
+    try:
+        os.removexattr(filename, etag_attribute)
+    except (AttributeError, OSError):
+        pass
+
+
+def file_md5(filename):
+    digest = hashlib.md5()
+    with open(filename, "rb") as file:
+        while chunk := file.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def matches_object(filename, stat):
+    # Whether the file on disk is the object described by stat: same size,
+    # and an ETag recorded when it was downloaded or a matching MD5
+    if stat["size"] is None or os.path.getsize(filename) != stat["size"]:
+        return False
+    try:
+        return os.getxattr(filename, etag_attribute).decode() == stat["etag"]
+    except (AttributeError, OSError):
+        pass
+    md5 = etag_md5(stat["etag"])
+    return md5 is not None and file_md5(filename) == md5
+
+
+@tracing.traced("download", size=lambda result, *args: result["size"])
+def download_file(bucket, key, filename, token=None, stat=None):
+    # Returns the size and SHA-256 of the downloaded object
+    with open_remote_file(bucket, key, token, stat) as remote:
+        with open(filename, "wb") as file:
+            # The ETag of what the file held before is no longer true
+            forget_etag(filename)
+            if remote.size is not None:
+                preallocate(file, remote.size)
+            try:
+                shutil.copyfileobj(remote, file, config.download_chunk_size)
+                size = file.tell()
+                if remote.size is not None and size != remote.size:
+                    raise IntegrityError(
+                        f"Downloaded {size} bytes of {key} from {bucket}, expected {remote.size}")
+            except BaseException:
+                # Drop what the preallocation added past the data, so the
+                # file does not pass for a complete copy
+                file.truncate()
+                raise
+        sha256 = remote.verify()
+        if sha256 is None:
+            raise IntegrityError(
+                f"Could not verify the download of {key} from {bucket}")
+    record_etag(filename, remote.etag)
+    logging.info(f"Downloaded {key} from {bucket} to {filename}")
+    return {"size": size, "sha256": sha256}
+
+
+class BulkDownload:
+    # Downloads many files (dicts of bucket, key and filename) side by side.
+    # Tokens are fetched ahead by threads of their own, so transfers do not
+    # wait on them. The number of transfers in flight starts small and is
+    # tuned from throughput, up to one per file: many small files are bound
+    # by latency and gain from more, a few large ones are already split into
+    # parallel ranges and do not. Files already on disk with the right size
+    # and ETag are skipped. The first failure cancels everything not started
+    # yet and is raised once the transfers in flight are over, so none of
+    # them writes into a job directory the caller has moved on from.
+    #
+    # download(bucket, key, filename, token, stat) is given the stat_object
+    # result when one was needed anyway. What it returns beyond the size
+    # (e.g. the data cache's hits and misses) is summed up per key.
+    def __init__(self, files, download):
+        self.files = files
+        self.download = download
+        self.api = get_api_session(
+            pool_size=2 * config.download_files_max_concurrency)
+        maximum = max(1, min(len(files), config.download_files_max_concurrency))
+        self.concurrency = AdaptiveConcurrency(
+            config.download_files_initial_concurrency, maximum)
+        self.failed = threading.Event()
+        self.lock = threading.Lock()
+        self.downloaded = 0
+        self.skipped = 0
+        self.bytes = 0
+        self.counts = collections.Counter()
+
+    def transfer(self, file, token):
+        self.concurrency.acquire()
+        size = 0
+        try:
+            if self.failed.is_set():
+                return
+            token = token.result()
+            stat = None
+            if os.path.exists(file["filename"]):
+                stat = stat_object(file["bucket"], file["key"], token)
+                if matches_object(file["filename"], stat):
+                    with self.lock:
+                        self.skipped += 1
+                    return
+            result = self.download(
+                file["bucket"], file["key"], file["filename"], token, stat)
+            size = result["size"] if result is not None else os.path.getsize(
+                file["filename"])
+            with self.lock:
+                self.downloaded += 1
+                self.bytes += size
+                for name, count in (result or {}).items():
+                    if name not in ("size", "sha256"):
+                        self.counts[name] += count
+        except Exception:
+            self.failed.set()
+            raise
+        finally:
+            self.concurrency.release(size)
+
+    def run(self):
+        start = time.monotonic()
+        # As many token threads as transfers, so tokens keep ahead
+        token_executor = JobThreadPoolExecutor(self.concurrency.maximum)
+        executor = JobThreadPoolExecutor(self.concurrency.maximum)
+        try:
+            futures = [executor.submit(self.transfer, file, token_executor.submit(
+                get_download_token, self.api, file["bucket"], file["key"])) for file in self.files]
+            done, _ = concurrent.futures.wait(
+                futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+            for future in done:
+                if future.exception() is not None:
+                    raise future.exception()
+        finally:
+            token_executor.shutdown(wait=False, cancel_futures=True)
+            executor.shutdown(wait=True, cancel_futures=True)
+        elapsed = time.monotonic() - start
+        megabytes = self.bytes / 1024 / 1024
+        logging.info(
+            f"Downloaded {self.downloaded} files ({megabytes:.1f} MB) in {elapsed:.2f}s "
+            f"({megabytes / max(elapsed, 1e-6):.1f} MB/s, {self.skipped} already present, "
+            f"concurrency {self.concurrency.limit})")
+        return {"files": self.downloaded, "skipped": self.skipped, "bytes": self.bytes, **self.counts}
+
+
+@tracing.traced("download", size=lambda result, *args, **kwargs: result["bytes"])
+def concurrently_download(files, download=download_file):
+    # download(bucket, key, filename, token) fetches a single file
+    if len(files) == 0:
+        return {"files": 0, "skipped": 0, "bytes": 0}
+    return BulkDownload(files, download).run()
@@ -0,0 +1,12 @@
+import os
+
+
+def directory_size(directory):
+    total = 0
+    for root, _, files in os.walk(directory):
+        for file in files:
+            try:
+                total += os.lstat(os.path.join(root, file)).st_size
+            except FileNotFoundError:
+                pass
+    return total
@@ -0,0 +1,32 @@
+import base64
+import hashlib
+import re
+
+
+class IntegrityError(Exception):
+    pass
+
+
+def content_md5(data):
+    # Value for the Content-MD5 header, so the storage backend rejects a body
+    # that was corrupted on the way
+    digest = hashlib.md5(data)
+    return digest.hexdigest(), base64.b64encode(digest.digest()).decode()
+
+
+def etag_md5(etag):
+    # The ETag of an object uploaded in one request (and of every part of a
+    # multipart upload) is the MD5 of its content. Multipart objects have
+    # "<md5>-<parts>" ETags and some backends use other schemes, so anything
+    # that is not a plain MD5 cannot be checked.
+    if etag is None:
+        return None
+    etag = etag.strip().removeprefix("W/").strip('"').lower()
+    return etag if re.fullmatch(r"[0-9a-f]{32}", etag) else None
+
+
+def verify_md5(etag, md5_hex, what):
+    expected = etag_md5(etag)
+    if expected is not None and expected != md5_hex:
+        raise IntegrityError(
+            f"Checksum mismatch for {what}: server has MD5 {expected}, we have {md5_hex}")
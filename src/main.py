@@ -3,16 +3,27 @@ import config
 import logging
 from checkpoints import monitor_checkpoint_directories, download_checkpoint
 import threading
-from api import get_api_session
+from api import api_stats, current_job, in_job_context
 from download import concurrently_download
-from upload import upload_file
-from webhooks import send_heartbeat, send_complete_webhook
+from cache import data_cache
+from upload import abort_stale_uploads, upload_file
+from webhooks import send_heartbeat, send_complete_webhook, send_failed_webhook
 from train import train
 from class_data import monitor_class_data
+from prefetch import Prefetcher
+from work import work_poller
+from slots import create_slots
+from models import model_cache, model_fields, start_prewarm
+from preprocess import preprocess_instance_images, start_pool
+from trash import trash
+import warm
+import metrics
+import progress
+import preemption
+import tracing
 import time
 import signal
 import os
-import shutil
 
 
 log_format = "%(asctime)s - %(levelname)s - %(name)s - %(message)s"
@@ -20,147 +31,247 @@ logging.basicConfig(level=config.log_level, format=log_format,
                     datefmt="%m/%d/%Y %H:%M:%S")
 
 
-def get_work():
-    api = get_api_session()
-    url = config.api_base_url + "/work"
-    response = api.get(url, params={
-        "machine_id": config.salad_machine_id,
-        "container_group_id": config.salad_container_group_id,
-        "organization_name": config.salad_organization_name,
-        "project_name": config.salad_project_name,
-        "container_group_name": config.salad_container_group_name,
-    })
-    response.raise_for_status()
-    body = response.json()
-    if len(body) == 0:
-        return None
-    return body[0]
-
-
 keep_alive = True
-heartbeat_active = False
 
 
-def heartbeat(job_id, failed_event):
-    global heartbeat_active
+def heartbeat(job_id, failed_event, heartbeat_stop):
     global keep_alive
-    while heartbeat_active:
+    while keep_alive and not heartbeat_stop.is_set():
         try:
-            send_heartbeat(job_id)
-            time.sleep(config.heartbeat_interval)
+            with tracing.span("heartbeat", "main", job_id=job_id):
+                send_heartbeat(job_id)
+            heartbeat_stop.wait(config.heartbeat_interval)
         except HTTPError as e:
             if e.response.status_code == 400:
                 logging.info(
                     f"Stopping heartbeat for job {job_id}. Job has been canceled.")
-                heartbeat_active = False
                 failed_event.set()
                 break
         except Exception as e:
             logging.error(f"Error: {e}")
             keep_alive = False
-            heartbeat_active = False
             failed_event.set()
             break
 
 
-def reset_for_next_job():
-    shutil.rmtree(config.instance_dir)
-    os.makedirs(config.instance_dir, exist_ok=True)
-    shutil.rmtree(config.class_dir)
-    os.makedirs(config.class_dir, exist_ok=True)
-    shutil.rmtree(config.output_dir)
-    os.makedirs(config.output_dir, exist_ok=True)
+def log_api_usage(job_id):
+    stats = api_stats(job_id)
+    logging.info(
+        f"API usage for job {job_id}: {stats['requests']} requests ({stats['connections']} connections opened by the worker so far)")
 
 
-def main():
-    global keep_alive
-    global heartbeat_active
+def finish_trace(job):
+    path = tracing.finish_job(job["id"])
+    if path is None or not config.trace_upload:
+        return
+    key = f"{job['checkpoint_prefix']}trace-{time.strftime('%Y%m%dT%H%M%S')}.json"
+    try:
+        upload_file(path, job["checkpoint_bucket"], key)
+    except Exception as e:
+        logging.error(f"Error: Failed to upload trace of job {job['id']}: {e}")
+
+
+def reset_for_next_job(slot):
+    # The old directories are deleted in the background
+    for directory in (slot.instance_dir, slot.class_dir, slot.output_dir):
+        trash.reset(directory)
+
+
+def download_job_data(job, instance_dir, class_dir, output_dir):
+    # The base models download alongside the data. Prefetched jobs get their
+    # models fetched while the current job trains.
+    model_thread = threading.Thread(target=in_job_context(model_cache.prewarm), args=(
+        [job[field] for field in model_fields if job.get(field)],))
+    model_thread.start()
+
+    with metrics.phase(job["id"], "wait_for_disk"):
+        trash.wait_for_space(instance_dir, config.disk_min_free_bytes)
+
+    if job["resume_from"] is not None:
+        logging.info(f"Resuming from {job['resume_from']}")
+        with metrics.phase(job["id"], "download_checkpoint") as record:
+            record["bytes"] = download_checkpoint(job["checkpoint_bucket"],
+                                                  job["resume_from"], output_dir)
+
+    images = [{"bucket": job["data_bucket"], "key": image,
+               "filename": f"{instance_dir}/{image.split('/')[-1]}"} for image in job["instance_data_keys"]]
+    if "class_data_keys" in job and job["class_data_keys"] is not None and len(job["class_data_keys"]) > 0:
+        images += [{"bucket": job["data_bucket"], "key": image,
+                    "filename": f"{class_dir}/{image.split('/')[-1]}"} for image in job["class_data_keys"]]
+
+    with metrics.phase(job["id"], "download_data") as record:
+        downloaded = concurrently_download(images, download=data_cache.fetch)
+        record["bytes"] = sum(os.path.getsize(image["filename"])
+                              for image in images)
+
+    if data_cache.enabled():
+        logging.info(
+            f"Data cache for job {job['id']}: {downloaded.get('cache_hits', 0)} hits, "
+            f"{downloaded.get('cache_misses', 0)} misses, {downloaded.get('cache_evictions', 0)} evictions")
+
+    if config.preprocess_images:
+        with metrics.phase(job["id"], "preprocess"):
+            preprocess_instance_images(job, instance_dir)
+
+    model_thread.join()
+
+
+prefetcher = Prefetcher(work_poller.poll, download_job_data, config.prefetch_depth,
+                        config.prefetch_max_bytes, config.prefetch_dir)
+
+
+def run_job(job, slot, prefetched=None):
+    logging.info(f"Got work: {job['id']} ({slot})")
+    tracing.start_job(job["id"])
+    job_should_stop = threading.Event()
+    # Requests made for the job, on this thread and the ones it starts, are
+    # counted against it
+    context_token = current_job.set(job["id"])
+    heartbeat_stop = threading.Event()
+    heartbeat_thread = threading.Thread(
+        target=in_job_context(heartbeat), args=(job["id"], job_should_stop, heartbeat_stop))
+    heartbeat_thread.start()
+    job_done = threading.Event()
+    preemption.track(job["id"], done=job_done,
+                     checkpointing_steps=job.get("checkpointing_steps"))
+    completed = False
+
+    # Whatever goes wrong, the job's heartbeat stops and the slot is left
+    # ready for the next job
+    try:
+        with metrics.phase(job["id"], "reset"):
+            reset_for_next_job(slot)
 
-    while keep_alive:
-        job_should_stop = threading.Event()
-        job = get_work()
-        if job is None:
-            logging.info("No work available. Sleeping for 5 seconds...")
-            time.sleep(5)
-            continue
-        logging.info(f"Got work: {job['id']}")
-        heartbeat_active = True
-        heartbeat_thread = threading.Thread(
-            target=heartbeat, args=(job["id"], job_should_stop))
-        heartbeat_thread.start()
-        reset_for_next_job()
-        if job["resume_from"] is not None:
-            logging.info(f"Resuming from {job['resume_from']}")
-            download_checkpoint(job["checkpoint_bucket"], job["resume_from"])
-
-        images = [{"bucket": job["data_bucket"], "key": image,
-                   "filename": f"{config.instance_dir}/{image.split('/')[-1]}"} for image in job["instance_data_keys"]]
         try:
-            concurrently_download(images)
+            if prefetched is not None and prefetched.ready:
+                logging.info(f"Using prefetched data for {job['id']}")
+                prefetched.move_into(
+                    slot.instance_dir, slot.class_dir, slot.output_dir)
+            else:
+                if prefetched is not None:
+                    prefetched.release()
+                download_job_data(job, slot.instance_dir,
+                                  slot.class_dir, slot.output_dir)
+            with metrics.phase(job["id"], "download_model"):
+                models = model_cache.acquire_job(job)
         except Exception as e:
             logging.error(f"Error: {e}")
-            heartbeat_active = False
-            job_should_stop.set()
-            heartbeat_thread.join()
-            continue
+            return
 
-        monitor_class_dir = None
+        if preemption.preempting.is_set():
+            # The worker is about to exit, the job is left for another one
+            logging.info(f"Not starting job {job['id']}, preempted")
+            return
 
-        if "class_data_keys" in job and job["class_data_keys"] is not None and len(job["class_data_keys"]) > 0:
-            class_images = [{"bucket": job["data_bucket"], "key": image,
-                             "filename": f"{config.class_dir}/{image.split('/')[-1]}"} for image in job["class_data_keys"]]
-            try:
-                concurrently_download(class_images)
-            except Exception as e:
-                logging.error(f"Error: {e}")
-                heartbeat_active = False
-                job_should_stop.set()
-                heartbeat_thread.join()
-                continue
+        monitor_class_dir = None
 
         if "class_data_prefix" in job and job["class_data_prefix"]:
             monitor_class_dir = threading.Thread(
-                target=monitor_class_data, args=(config.class_dir, job["data_bucket"], job["class_data_prefix"], job_should_stop,))
+                target=in_job_context(monitor_class_data), args=(slot.class_dir, job["data_bucket"], job["class_data_prefix"], job_should_stop,))
             monitor_class_dir.start()
 
         training_thread = threading.Thread(
-            target=train, args=(job, job_should_stop,))
+            target=in_job_context(train), args=(job, job_should_stop, slot, models,))
         monitoring_thread = threading.Thread(
-            target=monitor_checkpoint_directories, args=(config.output_dir, job["checkpoint_bucket"], job["checkpoint_prefix"], job["id"], job_should_stop,))
+            target=in_job_context(monitor_checkpoint_directories), args=(slot.output_dir, job["checkpoint_bucket"], job["checkpoint_prefix"], job["id"], job_should_stop,))
 
         training_thread.start()
         monitoring_thread.start()
         logging.info(f"Training and monitoring threads started: {job['id']}")
+        prefetcher.start()
 
         training_thread.join()
         logging.info(f"Training process exited: {job['id']}")
+        model_cache.release_job(job)
         monitoring_thread.join()
         logging.info(f"Monitoring process exited: {job['id']}")
         if monitor_class_dir is not None:
             monitor_class_dir.join()
-            logging.info(f"Class data monitoring process exited: {job['id']}")
-
-        if "pytorch_lora_weights.safetensors" in os.listdir(config.output_dir):
-            upload_file(f"{config.output_dir}/pytorch_lora_weights.safetensors",
-                        job["checkpoint_bucket"], f"{job['checkpoint_prefix']}pytorch_lora_weights.safetensors")
-            send_complete_webhook(
-                job["checkpoint_bucket"], f"{job['checkpoint_prefix']}pytorch_lora_weights.safetensors", job["id"])
+            logging.info(
+                f"Class data monitoring process exited: {job['id']}")
 
-        heartbeat_active = False
+        lora_weights = f"{slot.output_dir}/pytorch_lora_weights.safetensors"
+        if os.path.exists(lora_weights):
+            try:
+                with metrics.phase(job["id"], "final_upload") as record:
+                    checksum = upload_file(lora_weights, job["checkpoint_bucket"],
+                                           f"{job['checkpoint_prefix']}pytorch_lora_weights.safetensors")
+                    record["bytes"] = checksum["size"]
+                send_complete_webhook(
+                    job["checkpoint_bucket"], f"{job['checkpoint_prefix']}pytorch_lora_weights.safetensors", job["id"], checksum)
+                completed = True
+            except Exception as e:
+                logging.error(
+                    f"Error: Failed to upload the weights of job {job['id']}: {e}")
+                # A preempted job is not failed, it resumes from its last checkpoint
+                if not preemption.preempting.is_set():
+                    send_failed_webhook(job["checkpoint_bucket"],
+                                        job["checkpoint_prefix"], job["id"])
+    finally:
+        heartbeat_stop.set()
+        job_should_stop.set()
         heartbeat_thread.join()
-        reset_for_next_job()
-        if job_should_stop.is_set() and "pytorch_lora_weights.safetensors" not in os.listdir(config.output_dir):
+        log_api_usage(job["id"])
+        with metrics.phase(job["id"], "reset"):
+            reset_for_next_job(slot)
+        metrics.finish_job(job["id"])
+        progress.finish_job(job["id"])
+        finish_trace(job)
+        preemption.untrack(job["id"])
+        current_job.reset(context_token)
+        job_done.set()
+        if completed:
+            logging.info(f"Work complete: {job['id']}")
+        else:
             logging.info(
                 f"Job {job['id']} failed or was canceled. Moving on to next job.")
+
+
+def run_slot(slot):
+    # Slots claim their jobs independently, each one takes the next job as
+    # soon as its last one is done
+    while keep_alive:
+        prefetched = prefetcher.take()
+        job = prefetched.job if prefetched is not None else work_poller.wait_for_work(
+            lambda: keep_alive)
+        if job is None:
             continue
-        logging.info(f"Work complete: {job['id']}")
+        if preemption.preempting.is_set():
+            break
+        run_job(job, slot, prefetched)
+
+
+def main():
+    # Before any thread is started, the pool's workers are forked
+    start_pool()
+    metrics.start_server()
+    prefetcher.clear()
+    abort_stale_uploads()
+    start_prewarm()
+    slots = create_slots()
+    for slot in slots:
+        for directory in (slot.instance_dir, slot.class_dir, slot.output_dir):
+            trash.sweep(directory)
+    warm.start_daemons(slots)
+    if len(slots) == 1:
+        run_slot(slots[0])
+        return
+    threads = [threading.Thread(target=run_slot, args=(slot,), name=f"slot-{slot.index}")
+               for slot in slots]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
 
 
 def signal_handler(sig, frame):
     global keep_alive
-    global heartbeat_active
     keep_alive = False
-    heartbeat_active = False
+    if sig == signal.SIGTERM:
+        # The preemption exits the worker once it is done
+        logging.info("Preempted, saving progress before exiting...")
+        preemption.start()
+        return
     logging.info("Exiting...")
     exit(0)
 
@@ -170,3 +281,4 @@ signal.signal(signal.SIGTERM, signal_handler)
 
 if __name__ == "__main__":
     main()
+    preemption.wait()
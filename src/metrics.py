@@ -0,0 +1,130 @@
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import json
+import logging
+import threading
+import time
+import config
+import tracing
+
+# Phase totals across all jobs, exported on the metrics endpoint
+totals = {}
+# Phases of the jobs currently in progress, reported with their webhooks
+jobs = {}
+# Event counts that are not tied to a job, e.g. polls for work
+counters = {}
+lock = threading.Lock()
+
+
+@contextmanager
+def phase(job_id, name):
+    # Times the block as one phase of the job. The block can set
+    # record["bytes"] to the amount of data it moved.
+    record = {"bytes": 0}
+    start = time.monotonic()
+    try:
+        yield record
+    finally:
+        record_phase(job_id, name, time.monotonic() - start, record["bytes"])
+
+
+def record_phase(job_id, name, seconds, num_bytes):
+    if tracing.enabled:
+        end = time.monotonic()
+        tracing.add(name, "phase", end - seconds, end,
+                    {"job_id": job_id, "bytes": num_bytes})
+    with lock:
+        total = totals.setdefault(
+            name, {"count": 0, "seconds": 0.0, "bytes": 0})
+        total["count"] += 1
+        total["seconds"] += seconds
+        total["bytes"] += num_bytes
+        job = jobs.setdefault(job_id, {})
+        job_phase = job.setdefault(name, {"seconds": 0.0, "bytes": 0})
+        job_phase["seconds"] += seconds
+        job_phase["bytes"] += num_bytes
+
+    entry = {
+        "time": time.time(),
+        "job_id": job_id,
+        "phase": name,
+        "seconds": round(seconds, 3),
+        "bytes": num_bytes,
+        "mb_per_second": throughput(seconds, num_bytes),
+    }
+    logging.debug(f"Phase {name} of job {job_id}: {entry}")
+    if config.metrics_log is not None:
+        with lock, open(config.metrics_log, "a") as file:
+            file.write(json.dumps(entry) + "\n")
+
+
+def increment(name, count=1):
+    with lock:
+        counters[name] = counters.get(name, 0) + count
+
+
+def throughput(seconds, num_bytes):
+    if num_bytes == 0 or seconds <= 0:
+        return None
+    return round(num_bytes / 1024 / 1024 / seconds, 2)
+
+
+def job_summary(job_id):
+    with lock:
+        phases = jobs.get(job_id, {})
+        return {name: {"seconds": round(values["seconds"], 3),
+                       "bytes": values["bytes"],
+                       "mb_per_second": throughput(values["seconds"], values["bytes"])}
+                for name, values in phases.items()}
+
+
+def finish_job(job_id):
+    summary = job_summary(job_id)
+    logging.info(f"Phase timings for job {job_id}: {summary}")
+    with lock:
+        jobs.pop(job_id, None)
+    return summary
+
+
+def render():
+    lines = []
+    with lock:
+        for metric, field, kind in (("phase_runs_total", "count", "counter"),
+                                    ("phase_seconds_total", "seconds", "counter"),
+                                    ("phase_bytes_total", "bytes", "counter")):
+            lines.append(f"# TYPE dreambooth_worker_{metric} {kind}")
+            for name, total in sorted(totals.items()):
+                lines.append(
+                    f'dreambooth_worker_{metric}{{phase="{name}"}} {total[field]}')
+        for name, count in sorted(counters.items()):
+            lines.append(f"# TYPE dreambooth_worker_{name}_total counter")
+            lines.append(f"dreambooth_worker_{name}_total {count}")
+        lines.append("# TYPE dreambooth_worker_jobs_in_progress gauge")
+        lines.append(f"dreambooth_worker_jobs_in_progress {len(jobs)}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server():
+    if config.metrics_port <= 0:
+        return None
+    server = ThreadingHTTPServer(("", config.metrics_port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(
+        f"Serving metrics on http://0.0.0.0:{config.metrics_port}/metrics")
+    return server
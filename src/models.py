@@ -0,0 +1,165 @@
+import fnmatch
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import config
+from fsutil import directory_size
+
+try:
+    from huggingface_hub import list_repo_files, snapshot_download
+except ImportError:
+    snapshot_download = None
+
+# Job fields naming a base model, passed on to the training script
+model_fields = ["pretrained_model_name_or_path",
+                "pretrained_vae_model_name_or_path"]
+
+support_extensions = (".json", ".txt", ".model")
+# Weights under the names from_pretrained looks for, possibly sharded
+weight_name = re.compile(
+    r"(diffusion_pytorch_model|model|pytorch_model)(-\d+-of-\d+)?\.(safetensors|bin)")
+
+
+def loaded_files(files, ignore_patterns):
+    # The files of a repository that from_pretrained loads, out of its file
+    # list. Pipelines (with a model_index.json) load their components from
+    # subfolders. Weights under other names (e.g. single-file checkpoints for
+    # other tools) and variants (e.g. diffusion_pytorch_model.fp16.safetensors)
+    # are skipped, and in each folder safetensors are preferred over .bin.
+    files = [file for file in files
+             if not any(fnmatch.fnmatch(file, pattern) for pattern in ignore_patterns)]
+    pipeline = "model_index.json" in files
+    selected = [file for file in files if file.endswith(support_extensions)]
+    weights = {}
+    for file in files:
+        folder, name = os.path.split(file)
+        match = weight_name.fullmatch(name)
+        if match is None or (pipeline and folder == ""):
+            continue
+        weights.setdefault(folder, {}).setdefault(match.group(3), []).append(file)
+    for by_format in weights.values():
+        selected += by_format.get("safetensors", by_format.get("bin", []))
+    return selected
+
+
+class ModelCache:
+    # Keeps base models from the Hugging Face Hub on local disk, so training
+    # starts from local weights. Models are downloaded once into `directory`
+    # and evicted least recently used first once the cache grows past
+    # `max_bytes`. Pinned models and models used by a running job are never
+    # evicted. A model that is still downloading (e.g. being pre-warmed) is
+    # waited for rather than downloaded twice.
+    def __init__(self, directory, max_bytes, pinned, ignore_patterns):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.pinned = set(pinned)
+        self.ignore_patterns = ignore_patterns
+        self.in_use = {}
+        self.downloads = {}
+        self.lock = threading.Lock()
+        if self.enabled():
+            os.makedirs(directory, exist_ok=True)
+
+    def enabled(self):
+        return self.max_bytes > 0 and snapshot_download is not None
+
+    def model_path(self, name):
+        return os.path.join(self.directory, name.replace("/", "--"))
+
+    def acquire(self, name):
+        # Returns a local path for the model, downloading it if needed, and
+        # keeps it from being evicted until released. Names that are local
+        # paths already, or that cannot be fetched, are returned as they are
+        # and left to the training script.
+        if not self.enabled() or name is None or os.path.exists(name):
+            return name
+        # Models baked into the image live in the Hub's own cache
+        try:
+            return snapshot_download(name, local_files_only=True)
+        except Exception:
+            pass
+        with self.lock:
+            self.in_use[name] = self.in_use.get(name, 0) + 1
+            download_lock = self.downloads.setdefault(name, threading.Lock())
+        path = self.model_path(name)
+        try:
+            with download_lock:
+                if not os.path.exists(os.path.join(path, ".complete")):
+                    self.download(name, path)
+        except Exception as e:
+            logging.warning(
+                f"Failed to fetch model {name}, leaving it to the training script: {e}")
+            self.release(name)
+            return name
+        os.utime(os.path.join(path, ".complete"))
+        self.evict()
+        return path
+
+    def download(self, name, path):
+        start = time.monotonic()
+        snapshot_download(name, local_dir=path,
+                          allow_patterns=loaded_files(list_repo_files(name), self.ignore_patterns))
+        with open(os.path.join(path, ".complete"), "w") as marker:
+            marker.write(name)
+        logging.info(
+            f"Downloaded model {name} in {time.monotonic() - start:.1f}s ({directory_size(path) / 1024 / 1024 / 1024:.2f} GB)")
+
+    def release(self, name):
+        with self.lock:
+            if name in self.in_use:
+                self.in_use[name] -= 1
+                if self.in_use[name] == 0:
+                    del self.in_use[name]
+
+    def acquire_job(self, job):
+        # Resolves the models of a job, returns the paths by job field
+        return {field: self.acquire(job.get(field)) for field in model_fields}
+
+    def release_job(self, job):
+        for field in model_fields:
+            self.release(job.get(field))
+
+    def prewarm(self, names):
+        for name in names:
+            logging.info(f"Pre-warming model {name}")
+            self.acquire(name)
+            self.release(name)
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                marker = os.path.join(entry.path, ".complete")
+                if entry.is_dir() and os.path.exists(marker):
+                    with open(marker) as file:
+                        entries.append((os.path.getmtime(marker), file.read(), entry))
+            sizes = {entry.path: directory_size(entry.path)
+                     for _, _, entry in entries}
+            total = sum(sizes.values())
+            for _, name, entry in sorted(entries, key=lambda item: item[0]):
+                if total <= self.max_bytes:
+                    break
+                if name in self.pinned or name in self.in_use:
+                    continue
+                logging.info(f"Evicting model {name} from the model cache")
+                os.remove(os.path.join(entry.path, ".complete"))
+                shutil.rmtree(entry.path, ignore_errors=True)
+                total -= sizes[entry.path]
+
+
+model_cache = ModelCache(config.model_cache_dir, config.model_cache_max_bytes,
+                         config.model_pinned, config.model_ignore_patterns)
+
+
+def start_prewarm():
+    # Pinned models are always wanted, so they are pre-warmed too
+    names = list(dict.fromkeys(config.model_pinned + config.model_prewarm))
+    if not model_cache.enabled() or len(names) == 0:
+        return None
+    thread = threading.Thread(
+        target=model_cache.prewarm, args=(names,), daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,147 @@
+import logging
+import os
+import threading
+import time
+import config
+import metrics
+import progress
+import tracing
+
+# What a preemption has to act on for each job in progress: the training
+# process, the job's checkpoint uploader, its checkpointing interval and an
+# event set when the job is done
+jobs = {}
+lock = threading.Lock()
+preempting = threading.Event()
+# Monotonic time by which the preemption has to be done
+deadline = None
+
+
+def track(job_id, **fields):
+    with lock:
+        jobs.setdefault(job_id, {}).update(fields)
+
+
+def untrack(job_id):
+    with lock:
+        jobs.pop(job_id, None)
+
+
+def signal_training(process):
+    # The training process leads its own process group, so the launcher and
+    # the script it started both get the signal
+    try:
+        os.killpg(process.pid, config.preempt_signal)
+    except ProcessLookupError:
+        pass
+
+
+def wait_for_job(job_id, tracked, deadline):
+    # Past training, let the final upload finish
+    start = time.monotonic()
+    done = tracked.get("done")
+    if done is not None and done.wait(max(0, deadline - time.monotonic())):
+        logging.info(
+            f"Job {job_id} finished {time.monotonic() - start:.1f}s into the preemption")
+
+
+def seconds_to_checkpoint(job_id, checkpointing_steps):
+    # Estimated from training's progress, None if it cannot tell. Training
+    # that ends first writes the final weights instead.
+    state = progress.get(job_id) or {}
+    step = state.get("step")
+    rate = state.get("it_per_second")
+    if step is None or not rate or not checkpointing_steps:
+        return None
+    target = (step // checkpointing_steps + 1) * checkpointing_steps
+    if state.get("total_steps"):
+        target = min(target, state["total_steps"])
+    return (target - step) / rate
+
+
+def preempt_job(job_id, tracked, deadline):
+    process = tracked.get("process")
+    uploader = tracked.get("uploader")
+    if process is None or uploader is None or process.poll() is not None:
+        wait_for_job(job_id, tracked, deadline)
+        return
+
+    start = time.monotonic()
+    checkpoints_before = uploader.submitted
+    uploader.prioritize()
+    if config.preempt_signal is not None:
+        logging.info(
+            f"Asking training for job {job_id} to write a checkpoint ({config.preempt_signal.name})")
+        signal_training(process)
+    else:
+        # Training scripts that do not handle the signal would be killed by
+        # it, they keep training to their next checkpoint instead. Unless it
+        # comes in time, only an upload already in progress is waited for.
+        expected = seconds_to_checkpoint(
+            job_id, tracked.get("checkpointing_steps"))
+        if expected is None or start + expected > deadline:
+            logging.info(
+                f"Not waiting for job {job_id}: its next checkpoint is not expected within the grace period"
+                + (f" (in {expected:.0f}s)" if expected is not None else ""))
+            uploader.wait(uploader.idle, deadline)
+            return
+        logging.info(
+            f"Waiting for training of job {job_id} to write its next checkpoint, expected in {expected:.0f}s")
+    # The checkpoint counts as written once the monitor has seen it complete.
+    # A process that exits without writing one ends the wait early.
+    written = uploader.wait(lambda: uploader.submitted > checkpoints_before or process.poll() is not None,
+                            deadline)
+    written = written and uploader.submitted > checkpoints_before
+    checkpoint_seconds = time.monotonic() - start
+    metrics.record_phase(job_id, "preempt_checkpoint", checkpoint_seconds, 0)
+    if not written and process.poll() == 0:
+        # Training finished on its own within the grace period
+        wait_for_job(job_id, tracked, deadline)
+        return
+    if not written:
+        logging.error(
+            f"Error: No checkpoint written for job {job_id} after {checkpoint_seconds:.1f}s")
+        return
+
+    upload_start = time.monotonic()
+    uploaded = uploader.wait(uploader.idle, deadline)
+    upload_seconds = time.monotonic() - upload_start
+    metrics.record_phase(job_id, "preempt_upload", upload_seconds, 0)
+    logging.info(
+        f"Preemption of job {job_id}: checkpoint written in {checkpoint_seconds:.1f}s, "
+        f"{'uploaded' if uploaded else 'upload not finished'} in {upload_seconds:.1f}s")
+
+
+def preempt():
+    # Saves what it can of every job in progress within the grace period,
+    # then ends the worker
+    global deadline
+    start = time.monotonic()
+    deadline = start + config.preempt_grace_seconds
+    with lock:
+        tracked_jobs = {job_id: dict(fields) for job_id, fields in jobs.items()}
+    threads = [threading.Thread(target=preempt_job, args=(job_id, tracked, deadline))
+               for job_id, tracked in tracked_jobs.items()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(max(0, deadline - time.monotonic()))
+    for job_id in tracked_jobs:
+        tracing.finish_job(job_id)
+    logging.info(
+        f"Preemption handled in {time.monotonic() - start:.1f}s of {config.preempt_grace_seconds}s, exiting")
+    logging.shutdown()
+    os._exit(0)
+
+
+def start():
+    if preempting.is_set():
+        return
+    preempting.set()
+    threading.Thread(target=preempt, daemon=True).start()
+
+
+def wait():
+    # Keeps the worker alive until a preemption in progress ends it
+    if preempting.is_set():
+        threading.Event().wait()
@@ -0,0 +1,148 @@
+import collections
+import logging
+import os
+import shutil
+import threading
+from requests import HTTPError
+import config
+import preemption
+from api import current_job
+from fsutil import directory_size
+from trash import trash
+from webhooks import send_heartbeat
+
+
+class PrefetchedJob:
+    # A job claimed ahead of time whose inputs are downloaded into a staging
+    # directory. It is kept alive with its own heartbeat until the worker is
+    # ready to run it.
+    def __init__(self, job, directory):
+        self.job = job
+        self.directory = directory
+        self.instance_dir = os.path.join(directory, "instance")
+        self.class_dir = os.path.join(directory, "class")
+        self.output_dir = os.path.join(directory, "output")
+        for path in (self.instance_dir, self.class_dir, self.output_dir):
+            os.makedirs(path, exist_ok=True)
+        self.ready = False
+        self.downloaded = threading.Event()
+        self.canceled = False
+        self.stop = threading.Event()
+        self.heartbeat_thread = threading.Thread(
+            target=self.heartbeat, daemon=True)
+        self.heartbeat_thread.start()
+
+    def heartbeat(self):
+        while True:
+            try:
+                send_heartbeat(self.job["id"])
+            except HTTPError as e:
+                if e.response.status_code == 400:
+                    logging.info(
+                        f"Prefetched job {self.job['id']} has been canceled.")
+                    self.canceled = True
+                    return
+            except Exception as e:
+                logging.error(f"Error: {e}")
+            if self.stop.wait(config.heartbeat_interval):
+                return
+
+    def stop_heartbeat(self):
+        self.stop.set()
+        self.heartbeat_thread.join()
+
+    def move_into(self, instance_dir, class_dir, output_dir):
+        # Renames within one filesystem, so this is close to instant
+        for source, destination in ((self.instance_dir, instance_dir),
+                                    (self.class_dir, class_dir),
+                                    (self.output_dir, output_dir)):
+            for name in os.listdir(source):
+                shutil.move(os.path.join(source, name),
+                            os.path.join(destination, name))
+        self.release()
+
+    def release(self):
+        self.stop_heartbeat()
+        trash.discard(self.directory)
+
+
+class Prefetcher:
+    # Claims the next jobs while the current one is training and downloads
+    # their inputs, so the GPU does not sit idle between jobs. At most `depth`
+    # jobs are held, and no new one is claimed once the staging directory uses
+    # more than `max_bytes`.
+    def __init__(self, get_work, download_job_data, depth, max_bytes, staging_dir):
+        self.get_work = get_work
+        self.download_job_data = download_job_data
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.staging_dir = staging_dir
+        self.jobs = collections.deque()
+        self.thread = None
+        # Job slots start and take from the same prefetcher
+        self.lock = threading.Lock()
+
+    def enabled(self):
+        return self.depth > 0
+
+    def clear(self):
+        # Drops what a previous run left staged, called once at startup
+        if self.enabled():
+            shutil.rmtree(self.staging_dir, ignore_errors=True)
+            os.makedirs(self.staging_dir, exist_ok=True)
+
+    def start(self):
+        with self.lock:
+            if not self.enabled() or preemption.preempting.is_set() or (
+                    self.thread is not None and self.thread.is_alive()):
+                return
+            self.thread = threading.Thread(target=self.prefetch, daemon=True)
+            self.thread.start()
+
+    def prefetch(self):
+        # Nothing new is claimed once the worker is being preempted
+        while len(self.jobs) < self.depth and not preemption.preempting.is_set():
+            if directory_size(self.staging_dir) >= self.max_bytes:
+                logging.info("Prefetch disk budget used up.")
+                return
+            if not trash.wait_for_space(self.staging_dir, config.prefetch_min_free_bytes):
+                logging.info("Not enough free disk to prefetch.")
+                return
+            try:
+                job = self.get_work()
+            except Exception as e:
+                logging.error(f"Error: {e}")
+                return
+            if job is None:
+                return
+            logging.info(f"Prefetching work: {job['id']}")
+            current_job.set(job["id"])
+            prefetched = PrefetchedJob(
+                job, os.path.join(self.staging_dir, job["id"]))
+            self.jobs.append(prefetched)
+            try:
+                self.download_job_data(
+                    job, prefetched.instance_dir, prefetched.class_dir, prefetched.output_dir)
+                prefetched.ready = True
+            except Exception as e:
+                # The job is still ours, it is downloaded again when it runs
+                logging.error(f"Error: Failed to prefetch {job['id']}: {e}")
+                return
+            finally:
+                prefetched.downloaded.set()
+
+    def take(self):
+        # Wait for a prefetch in progress, it is the next job we would run
+        thread = self.thread
+        if thread is not None and len(self.jobs) == 0:
+            thread.join()
+        while True:
+            try:
+                prefetched = self.jobs.popleft()
+            except IndexError:
+                return None
+            prefetched.downloaded.wait()
+            prefetched.stop_heartbeat()
+            if not prefetched.canceled:
+                return prefetched
+            prefetched.release()
@@ -0,0 +1,87 @@
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import time
+import config
+from cache import DataCache, link_or_copy
+from preprocess_worker import Image, preprocess_image
+
+image_extensions = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tiff"}
+
+# Preprocessed images, addressed by the hash of the original file and the
+# settings they were produced with
+preprocess_cache = DataCache(config.preprocess_cache_dir,
+                             config.preprocess_cache_max_bytes if config.preprocess_images else 0)
+
+
+# Started by main() before any other thread, see start_pool
+pool = None
+
+
+def start_pool():
+    # The workers are forked, since spawned and forkserver workers import
+    # main.py again and run the worker's startup code. Forking is only safe
+    # while this process has a single thread, so they are all forked right
+    # away at startup and kept for the life of the worker.
+    global pool
+    if not config.preprocess_images or Image is None:
+        return
+    pool = concurrent.futures.ProcessPoolExecutor(
+        config.preprocess_workers, mp_context=multiprocessing.get_context("fork"))
+    pool.submit(os.getpid).result()
+
+
+def preprocess_instance_images(job, instance_dir):
+    # Replaces the images in instance_dir with resized copies from the cache.
+    # The originals are unlinked rather than overwritten, since they may be
+    # hardlinks into the data cache. Returns the number of bytes saved.
+    if not config.preprocess_images:
+        return 0
+    if Image is None:
+        logging.warning("Pillow is not installed, skipping image preprocessing")
+        return 0
+
+    sources = [entry.path for entry in os.scandir(instance_dir) if entry.is_file()
+               and os.path.splitext(entry.name)[1].lower() in image_extensions]
+    if len(sources) == 0:
+        return 0
+
+    os.makedirs(config.preprocess_cache_dir, exist_ok=True)
+    start = time.monotonic()
+    bytes_before = sum(os.path.getsize(source) for source in sources)
+    bytes_after = 0
+    produced = 0
+    try:
+        futures = {pool.submit(preprocess_image, source, int(job["resolution"]), bool(job["center_crop"]),
+                               config.preprocess_cache_dir, config.preprocess_quality): source
+                   for source in sources}
+    except concurrent.futures.BrokenExecutor as e:
+        # A worker died. A new pool would be forked from a process that is
+        # running threads by now, so the originals are kept until a restart.
+        logging.error(f"Error: Image preprocessing is unavailable: {e}")
+        return 0
+    for future in concurrent.futures.as_completed(futures):
+        source = futures[future]
+        try:
+            path, created = future.result()
+        except Exception as e:
+            logging.error(
+                f"Error: Failed to preprocess {source}, keeping the original: {e}")
+            bytes_after += os.path.getsize(source)
+            continue
+        if created:
+            produced += 1
+            preprocess_cache.add(path)
+        name = os.path.basename(source)
+        if os.path.splitext(name)[1].lower() not in (".jpg", ".jpeg"):
+            name += ".jpg"
+        os.remove(source)
+        link_or_copy(path, os.path.join(instance_dir, name))
+        bytes_after += os.path.getsize(path)
+    preprocess_cache.evict()
+
+    logging.info(
+        f"Preprocessed {len(sources)} instance images for job {job['id']} in {time.monotonic() - start:.2f}s "
+        f"({produced} new, {len(sources) - produced} cached), {bytes_before / 1024 / 1024:.1f}MB -> {bytes_after / 1024 / 1024:.1f}MB")
+    return bytes_before - bytes_after
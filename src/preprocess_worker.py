@@ -0,0 +1,48 @@
+import hashlib
+import os
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# What the preprocessing worker processes run. Kept apart from preprocess.py
+# and free of import-time side effects (no config, no caches), since a worker
+# process that is not forked imports the modules its function lives in.
+
+
+def cache_path(source, resolution, center_crop, cache_dir, quality):
+    digest = hashlib.sha256()
+    with open(source, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    digest.update(f"\0{resolution}\0{center_crop}\0{quality}".encode())
+    return os.path.join(cache_dir, digest.hexdigest() + ".jpg")
+
+
+def preprocess_image(source, resolution, center_crop, cache_dir, quality):
+    # Returns the cached image for the source and whether it had to be
+    # produced.
+    path = cache_path(source, resolution, center_crop, cache_dir, quality)
+    if os.path.exists(path):
+        os.utime(path)
+        return path, False
+
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image).convert("RGB")
+    # Resize the short side down to the training resolution, which is what
+    # the training script's dataloader does before cropping. Smaller images
+    # are left at their size.
+    scale = resolution / min(image.size)
+    if scale < 1:
+        image = image.resize((round(image.width * scale), round(image.height * scale)),
+                             Image.LANCZOS)
+    if center_crop and min(image.size) >= resolution:
+        left = (image.width - resolution) // 2
+        top = (image.height - resolution) // 2
+        image = image.crop((left, top, left + resolution, top + resolution))
+
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    image.save(temporary_path, "JPEG", quality=quality)
+    os.replace(temporary_path, path)
+    return path, True
@@ -0,0 +1,124 @@
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import config
+
+# Latest training progress of the jobs in progress, sent with each heartbeat
+jobs = {}
+lock = threading.Lock()
+
+# tqdm progress bars, as printed by the diffusers training scripts:
+#   Steps:  45%|████▌     | 450/1000 [05:12<06:21,  1.44it/s, loss=0.0512, lr=5e-6]
+tqdm_pattern = re.compile(
+    r"(\d+)/(\d+) \[([\d:]+)<([\d:?]+),\s*([\d.]+|\?)(it/s|s/it)(?:,\s*(.*))?\]")
+# Metrics logged outside of a progress bar, e.g. "loss=0.0512" or "loss: 0.0512"
+metric_pattern = re.compile(r"\b(loss|lr)\s*[=:]\s*([-+\d.eE]+)")
+
+
+def parse_duration(text):
+    if "?" in text:
+        return None
+    seconds = 0
+    for field in text.split(":"):
+        seconds = seconds * 60 + int(field)
+    return seconds
+
+
+def parse_line(line):
+    # Returns the progress fields found in one line of training output
+    fields = {}
+    match = tqdm_pattern.search(line)
+    if match is not None:
+        step, total, elapsed, remaining, rate, unit, postfix = match.groups()
+        fields["step"] = int(step)
+        fields["total_steps"] = int(total)
+        fields["elapsed_seconds"] = parse_duration(elapsed)
+        fields["eta_seconds"] = parse_duration(remaining)
+        if rate != "?":
+            rate = float(rate)
+            fields["it_per_second"] = rate if unit == "it/s" else (
+                1 / rate if rate > 0 else None)
+        line = postfix or ""
+    for name, value in metric_pattern.findall(line):
+        try:
+            fields[name] = float(value)
+        except ValueError:
+            pass
+    return fields
+
+
+class ProgressReader:
+    # Reads the merged stdout and stderr of the training process on its own
+    # thread, echoing it to our stdout and keeping the latest progress of the
+    # job. tqdm redraws its bar with carriage returns, so both \r and \n end a
+    # line.
+    def __init__(self, job_id, stream, baseline, slow_fraction):
+        self.job_id = job_id
+        self.stream = stream
+        self.baseline = baseline
+        self.slow_fraction = slow_fraction
+        self.flagged = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        with lock:
+            jobs[job_id] = {}
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        pending = b""
+        fd = self.stream.fileno()
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            sys.stdout.buffer.write(chunk)
+            sys.stdout.flush()
+            lines = re.split(rb"[\r\n]", pending + chunk)
+            pending = lines.pop()
+            for line in lines:
+                self.update(line.decode(errors="replace"))
+        self.update(pending.decode(errors="replace"))
+
+    def update(self, line):
+        fields = parse_line(line)
+        if len(fields) == 0:
+            return
+        fields["updated_at"] = time.time()
+        with lock:
+            progress = jobs.setdefault(self.job_id, {})
+            progress.update(fields)
+            progress["slow"] = self.is_slow(progress)
+        if progress["slow"] and not self.flagged:
+            self.flagged = True
+            logging.warning(
+                f"Training job {self.job_id} at {progress['it_per_second']:.2f} it/s, below {self.slow_fraction:.0%} of the fleet baseline of {self.baseline:.2f} it/s")
+
+    def is_slow(self, progress):
+        # The first steps include warmup and compilation, so a node is only
+        # judged once it has trained for a while
+        rate = progress.get("it_per_second")
+        if self.baseline <= 0 or rate is None or progress.get("step", 0) < config.slow_node_min_steps:
+            return False
+        return rate < self.baseline * self.slow_fraction
+
+    def join(self, timeout=None):
+        self.thread.join(timeout)
+
+    def is_alive(self):
+        return self.thread.is_alive()
+
+
+def get(job_id):
+    with lock:
+        progress = jobs.get(job_id)
+        return dict(progress) if progress else None
+
+
+def finish_job(job_id):
+    with lock:
+        return jobs.pop(job_id, None)
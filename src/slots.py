@@ -0,0 +1,68 @@
+import logging
+import os
+import subprocess
+import config
+
+
+class Slot:
+    # One job at a time runs in a slot, on the slot's GPUs and in the slot's
+    # own directories
+    def __init__(self, index, devices, instance_dir, class_dir, output_dir):
+        self.index = index
+        self.devices = devices
+        self.instance_dir = instance_dir
+        self.class_dir = class_dir
+        self.output_dir = output_dir
+        for path in (instance_dir, class_dir, output_dir):
+            os.makedirs(path, exist_ok=True)
+
+    def environment(self):
+        # Overrides for the training process's environment. Without devices
+        # (e.g. on a CPU-only machine) the inherited environment is kept.
+        if self.devices is None:
+            return {}
+        return {"CUDA_VISIBLE_DEVICES": ",".join(self.devices)}
+
+    def __str__(self):
+        devices = ",".join(self.devices) if self.devices else "default"
+        return f"slot {self.index} (GPUs {devices})"
+
+
+def detect_gpus():
+    if config.gpu_devices is not None:
+        return config.gpu_devices
+    try:
+        output = subprocess.run(["nvidia-smi", "--query-gpu=index", "--format=csv,noheader"],
+                                check=True, capture_output=True, text=True, timeout=30).stdout
+        return [line.strip() for line in output.splitlines() if line.strip()]
+    except (OSError, subprocess.SubprocessError) as e:
+        logging.info(f"No GPUs found with nvidia-smi: {e}")
+    visible = os.getenv("CUDA_VISIBLE_DEVICES")
+    if visible:
+        return [device.strip() for device in visible.split(",") if device.strip()]
+    return []
+
+
+def create_slots():
+    # With one slot the worker behaves as it always has: one job at a time,
+    # on every GPU (or those in GPU_DEVICES), in the configured directories.
+    # With more, the GPUs are split between the slots and each slot gets
+    # directories of its own next to the configured ones.
+    gpus = detect_gpus()
+    count = config.gpu_slots
+    if count <= 0:
+        count = max(1, len(gpus))
+    if count == 1:
+        return [Slot(0, config.gpu_devices, config.instance_dir, config.class_dir, config.output_dir)]
+
+    if 0 < len(gpus) < count:
+        logging.warning(
+            f"{count} slots requested but only {len(gpus)} GPUs found, running {len(gpus)} slots")
+        count = len(gpus)
+    slots = []
+    for index in range(count):
+        devices = gpus[index::count] if len(gpus) > 0 else None
+        slots.append(Slot(index, devices, f"{config.instance_dir}-{index}",
+                          f"{config.class_dir}-{index}", f"{config.output_dir}-{index}"))
+    logging.info(f"Running {count} job slots: {', '.join(str(slot) for slot in slots)}")
+    return slots
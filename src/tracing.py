@@ -0,0 +1,153 @@
+import collections
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import config
+
+# Spans of phases and I/O calls on every thread, written out per job as a
+# Chrome trace (open it in ui.perfetto.dev or chrome://tracing) to see how
+# the heartbeat, the watchdog observers, training and the transfer pools
+# overlap. Off unless TRACE_DIR is set, and then the hooks cost next to
+# nothing: traced functions are left undecorated and span() hands out one
+# shared no-op context manager.
+enabled = config.trace_dir is not None
+events = collections.deque(maxlen=config.trace_max_events)
+# Thread names by native thread id, for the trace's thread tracks
+threads = {}
+# Start time of every job in progress
+jobs = {}
+lock = threading.Lock()
+pid = os.getpid()
+
+if enabled:
+    os.makedirs(config.trace_dir, exist_ok=True)
+
+
+def add(name, category, start, end, details):
+    # Records a span from start to end (monotonic seconds) on this thread
+    thread_id = threading.get_native_id()
+    event = {"name": name, "cat": category, "ph": "X", "ts": start * 1e6,
+             "dur": (end - start) * 1e6, "pid": pid, "tid": thread_id, "args": details}
+    with lock:
+        if thread_id not in threads:
+            threads[thread_id] = threading.current_thread().name
+        events.append(event)
+
+
+class Span:
+    # Records the block as a span. The block can set record["bytes"] to the
+    # amount of data it moved, as with metrics.phase.
+    def __init__(self, name, category, details):
+        self.name = name
+        self.category = category
+        self.details = details
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self.details
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.details["error"] = exc_type.__name__
+        add(self.name, self.category, self.start,
+            time.monotonic(), self.details)
+        return False
+
+
+class NoSpan:
+    def __enter__(self):
+        return discarded
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+no_span = NoSpan()
+discarded = {}
+
+
+def span(name, category, **details):
+    if not enabled:
+        return no_span
+    return Span(name, category, details)
+
+
+def traced(category, size=None):
+    # Records every call of the decorated function as a span, with the bytes
+    # given by size(result, *args, **kwargs)
+    def decorate(function):
+        if not enabled:
+            return function
+        name = function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            details = {}
+            start = time.monotonic()
+            try:
+                result = function(*args, **kwargs)
+                if size is not None:
+                    details["bytes"] = size(result, *args, **kwargs)
+                return result
+            except BaseException as e:
+                details["error"] = type(e).__name__
+                raise
+            finally:
+                add(name, category, start, time.monotonic(), details)
+        return wrapper
+    return decorate
+
+
+def instant(name, category, **details):
+    if not enabled:
+        return
+    thread_id = threading.get_native_id()
+    with lock:
+        if thread_id not in threads:
+            threads[thread_id] = threading.current_thread().name
+        events.append({"name": name, "cat": category, "ph": "i", "s": "t",
+                       "ts": time.monotonic() * 1e6, "pid": pid, "tid": thread_id, "args": details})
+
+
+def start_job(job_id):
+    if enabled:
+        with lock:
+            jobs[job_id] = time.monotonic()
+
+
+def finish_job(job_id):
+    # Writes the spans of the job, and every span that overlapped it, to
+    # TRACE_DIR. Returns the path of the trace file.
+    if not enabled:
+        return None
+    end = time.monotonic() * 1e6
+    with lock:
+        start = jobs.pop(job_id, end / 1e6) * 1e6
+        selected = [event for event in events
+                    if event["args"].get("job_id") == job_id
+                    or (event["ts"] + event.get("dur", 0) >= start and event["ts"] <= end)]
+        # Spans still of interest to the other jobs in progress are kept
+        earliest = min(jobs.values(), default=end / 1e6) * 1e6
+        kept = [event for event in events
+                if event["ts"] + event.get("dur", 0) >= earliest
+                or event["args"].get("job_id") not in (None, job_id)]
+        events.clear()
+        events.extend(kept)
+        names = dict(threads)
+    metadata = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": "worker"}}]
+    metadata += [{"name": "thread_name", "ph": "M", "pid": pid, "tid": thread_id, "args": {"name": names[thread_id]}}
+                 for thread_id in {event["tid"] for event in selected}]
+    path = os.path.join(config.trace_dir, f"{job_id}.json")
+    try:
+        with open(path, "w") as file:
+            json.dump({"traceEvents": metadata + selected,
+                      "displayTimeUnit": "ms"}, file)
+    except OSError as e:
+        logging.error(f"Error: Failed to write trace of job {job_id}: {e}")
+        return None
+    logging.info(
+        f"Wrote trace of job {job_id} to {path} ({len(selected)} spans)")
+    return path
@@ -2,19 +2,26 @@ import config
 import logging
 import subprocess
 from webhooks import send_failed_webhook
+import metrics
+import progress
+import preemption
 import os
+import shlex
+import signal
 import time
+import warm
 
-env = os.environ.copy()
 
-
-def job_to_command_array(job):
+def job_to_command_array(job, slot, models=None):
+    # models maps the job's model fields to local paths, where they resolved
+    models = {field: path for field, path in (
+        models or {}).items() if path is not None}
     command_array = [
-        "accelerate", "launch", job['training_script'],
-        f"--pretrained_model_name_or_path={job['pretrained_model_name_or_path']}",
-        f"--instance_data_dir={config.instance_dir}",
-        f"--pretrained_vae_model_name_or_path={job['pretrained_vae_model_name_or_path']}",
-        f"--output_dir={config.output_dir}",
+        *shlex.split(config.training_launcher), config.training_script or job['training_script'],
+        f"--pretrained_model_name_or_path={models.get('pretrained_model_name_or_path', job['pretrained_model_name_or_path'])}",
+        f"--instance_data_dir={slot.instance_dir}",
+        f"--pretrained_vae_model_name_or_path={models.get('pretrained_vae_model_name_or_path', job['pretrained_vae_model_name_or_path'])}",
+        f"--output_dir={slot.output_dir}",
         f"--instance_prompt=\"{job['instance_prompt']}\"",
         f"--mixed_precision={job['mixed_precision']}",
         f"--resolution={job['resolution']}",
@@ -53,7 +60,7 @@ def job_to_command_array(job):
 
     if job["with_prior_preservation"]:
         command_array.append("--with_prior_preservation")
-        command_array.append(f"--class_data_dir={config.class_dir}")
+        command_array.append(f"--class_data_dir={slot.class_dir}")
 
         if 'prior_loss_weight' in job:
             command_array.append(
@@ -78,24 +85,72 @@ def job_to_command_array(job):
     return command_array
 
 
-def train(job, stop_signal):
-    command_array = job_to_command_array(job)
+def train(job, stop_signal, slot, models=None):
+    with metrics.phase(job["id"], "train"):
+        run_training(job, stop_signal, slot, models)
+
+
+def close_output(process, reader, own_session):
+    # Processes spawned by the launcher can outlive it and keep the pipe
+    # open, so the reader is only given a while to see the end of the output.
+    # What is left of the training process's session is killed after that.
+    reader.join(10)
+    if reader.is_alive() and own_session:
+        logging.warning(
+            f"Training process {process.pid} exited with the output still open, killing what it left running")
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        reader.join(10)
+    if reader.is_alive():
+        # The reader still uses the pipe, closing it could hand its file
+        # descriptor to something else
+        logging.error(
+            f"Error: Output of training process {process.pid} is still open, leaving it to its reader")
+        return
+    process.stdout.close()
+
+
+def run_training(job, stop_signal, slot, models=None):
+    command_array = job_to_command_array(job, slot, models)
 
-    logging.info(f"Training command: {' '.join(command_array)}")
+    logging.info(f"Training command ({slot}): {' '.join(command_array)}")
 
     try:
-        env["WANDB_NAME"] = job["id"]
-        env["WANDB_RUN_ID"] = job["id"]
-        process = subprocess.Popen(command_array, env=env)
+        env = {**slot.environment(),
+               "WANDB_NAME": job["id"], "WANDB_RUN_ID": job["id"]}
+        daemon = warm.daemon_for(slot)
+        if daemon is not None:
+            # The daemon runs the script itself, without the launcher
+            process = daemon.run(
+                command_array[len(shlex.split(config.training_launcher)):], env)
+        else:
+            # Each training process gets its own copy, slots run side by
+            # side. In a session of its own, so signals reach every process
+            # the launcher starts.
+            process = subprocess.Popen(
+                command_array, env={**os.environ, **env}, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                start_new_session=True)
+        preemption.track(job["id"], process=process)
+        reader = progress.ProgressReader(
+            job["id"], process.stdout,
+            job.get("baseline_it_per_second") or config.training_baseline_it_per_second,
+            config.slow_node_fraction).start()
 
         while process.poll() is None:
             if stop_signal.is_set():
                 logging.info(
                     "Received stop signal. Terminating training process.")
-                process.terminate()
+                try:
+                    os.killpg(process.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
                 process.wait()
+                close_output(process, reader, daemon is None)
                 return
             time.sleep(1)
+        close_output(process, reader, daemon is None)
         stop_signal.set()
         if process.returncode != 0:
             raise subprocess.CalledProcessError(
@@ -104,7 +159,9 @@ def train(job, stop_signal):
 
     except subprocess.CalledProcessError as e:
         logging.error(f"Error: Failed to train model: {e}")
-        send_failed_webhook(job["checkpoint_bucket"],
-                            job["checkpoint_prefix"], job["id"])
+        # A preempted job is not failed, it resumes from its last checkpoint
+        if not preemption.preempting.is_set():
+            send_failed_webhook(job["checkpoint_bucket"],
+                                job["checkpoint_prefix"], job["id"])
         stop_signal.set()
         exit(1)
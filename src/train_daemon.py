@@ -0,0 +1,249 @@
+import argparse
+import gc
+import io
+import logging
+import os
+import runpy
+import signal
+import sys
+import threading
+import time
+import traceback
+from multiprocessing.connection import Listener
+
+# A training process that outlives its jobs. The worker starts one per slot
+# (see warm.py) and sends it jobs over a local socket, as the argument list
+# the training script would be launched with. The script runs in this
+# process, so Python, torch and diffusers are imported once, and the
+# (experimental) diffusers backend keeps the base models it loads resident
+# for the next job.
+#
+# Protocol, one connection per daemon, one job at a time:
+#   worker -> daemon: {"type": "train", "argv": [script, *args], "env": {...}}
+#   daemon -> worker: {"type": "output", "data": bytes} while the job runs,
+#                     then {"type": "exit", "code": int}, with
+#                     "restart": True if the daemon exits after the job
+# The daemon exits when the connection closes, so it never outlives the
+# worker. Signals go to the daemon's process group as they would to a
+# training process: the script's own handlers (e.g. for the preemption
+# signal) are in place while it runs.
+
+
+def model_arguments(argv):
+    # The base models a job trains on, by their command line arguments
+    names = set()
+    for argument in argv:
+        for option in ("--pretrained_model_name_or_path=", "--pretrained_vae_model_name_or_path="):
+            if argument.startswith(option) and argument[len(option):] != "None":
+                names.add(argument[len(option):])
+    return names
+
+
+def reset_accelerate():
+    # The training scripts expect a fresh accelerate state in every process
+    if "accelerate.state" not in sys.modules:
+        return
+    try:
+        from accelerate.state import AcceleratorState
+        AcceleratorState._reset_state(reset_partial_state=True)
+    except Exception as e:
+        logging.warning(f"Failed to reset accelerate state: {e}")
+
+
+class PlainBackend:
+    # Keeps nothing of a job but the libraries it imported, every job loads
+    # its models itself
+    def prepare(self, argv):
+        pass
+
+    def reset(self, argv):
+        reset_accelerate()
+        gc.collect()
+        if "torch" in sys.modules:
+            sys.modules["torch"].cuda.empty_cache()
+
+
+class StubBackend:
+    # Stands in for the diffusers backend on a machine without GPUs, for use
+    # with bench/stub_train.py. The script sleeps STUB_MODEL_LOAD_SECONDS for
+    # every model not listed in STUB_RESIDENT_MODELS, which is set to the
+    # models earlier jobs loaded.
+    def __init__(self):
+        self.resident = set()
+
+    def prepare(self, argv):
+        os.environ["STUB_RESIDENT_MODELS"] = ",".join(sorted(self.resident))
+
+    def reset(self, argv):
+        self.resident = model_arguments(argv)
+
+
+class DiffusersBackend:
+    # Caches the models the training script loads with from_pretrained, so
+    # the next job with the same base model gets them without reading them
+    # from disk again. LoRA training leaves the base weights alone, only the
+    # adapters it adds (and the training state around them) are undone
+    # between jobs. A model whose own weights were trained is dropped, as are
+    # the models of a base model the next job does not use.
+    #
+    # Experimental: the instances are shared by the jobs that use them, and
+    # this has not been tested with the training scripts on GPUs yet.
+    def __init__(self):
+        logging.warning(
+            "The diffusers backend is experimental, models are kept resident between jobs")
+        import torch
+        import diffusers
+        import transformers
+        self.torch = torch
+        self.diffusers = diffusers
+        self.models = {}
+        for base in (diffusers.ModelMixin, transformers.PreTrainedModel):
+            base.from_pretrained = self.cached(base.from_pretrained.__func__)
+
+    def cached(self, load):
+        models = self.models
+
+        def from_pretrained(cls, name, *args, **kwargs):
+            key = (cls.__qualname__, str(name), repr(args),
+                   repr(sorted(kwargs.items(), key=lambda item: item[0])))
+            if key not in models:
+                models[key] = load(cls, name, *args, **kwargs)
+            else:
+                logging.info(f"Using resident {cls.__name__} from {name}")
+            return models[key]
+        return classmethod(from_pretrained)
+
+    def prepare(self, argv):
+        keep = model_arguments(argv)
+        for key in [key for key in self.models if key[1] not in keep]:
+            del self.models[key]
+        gc.collect()
+        self.torch.cuda.empty_cache()
+
+    def reset(self, argv):
+        for key, model in list(self.models.items()):
+            if getattr(model, "peft_config", None):
+                # diffusers models take a list of adapters, transformers
+                # models one at a time
+                if isinstance(model, self.diffusers.ModelMixin):
+                    model.delete_adapters(list(model.peft_config))
+                else:
+                    for name in list(model.peft_config):
+                        model.delete_adapter(name)
+            if any(parameter.requires_grad for parameter in model.parameters()):
+                # Trained beyond its adapters (e.g. a full text encoder
+                # finetune), it no longer holds the base weights
+                logging.info(f"Dropping trained {type(model).__name__} from {key[1]}")
+                del self.models[key]
+                continue
+            model.zero_grad(set_to_none=True)
+            model.eval()
+        reset_accelerate()
+        gc.collect()
+        self.torch.cuda.empty_cache()
+
+
+backends = {"plain": PlainBackend, "stub": StubBackend,
+            "diffusers": DiffusersBackend}
+
+
+class ConnectionWriter(io.TextIOBase):
+    # What the script writes to stdout and stderr goes back to the worker
+    def __init__(self, connection, lock):
+        super().__init__()
+        self.connection = connection
+        self.lock = lock
+
+    @property
+    def encoding(self):
+        return "utf-8"
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if len(text) > 0:
+            with self.lock:
+                self.connection.send(
+                    {"type": "output", "data": text.encode(errors="replace")})
+        return len(text)
+
+
+def run_job(backend, connection, lock, argv, env):
+    saved_environ = dict(os.environ)
+    saved_argv = sys.argv
+    saved_path = sys.path[:]
+    saved_streams = (sys.stdout, sys.stderr)
+    saved_handlers = logging.root.handlers[:]
+    saved_signals = {sig: signal.getsignal(sig)
+                     for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGUSR1, signal.SIGUSR2)}
+    code = 0
+    start = time.monotonic()
+    try:
+        os.environ.update(env)
+        backend.prepare(argv)
+        sys.argv = list(argv)
+        sys.path.insert(0, os.path.dirname(os.path.abspath(argv[0])))
+        sys.stdout = sys.stderr = ConnectionWriter(connection, lock)
+        # So the script's logging setup takes effect, as in a process of its own
+        logging.root.handlers = []
+        runpy.run_path(argv[0], run_name="__main__")
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        sys.stdout, sys.stderr = saved_streams
+        sys.argv = saved_argv
+        sys.path[:] = saved_path
+        logging.root.handlers = saved_handlers
+        for sig, handler in saved_signals.items():
+            signal.signal(sig, handler)
+        os.environ.clear()
+        os.environ.update(saved_environ)
+    try:
+        backend.reset(argv)
+    except Exception as e:
+        # The job itself is done, the worker starts a new daemon for the next
+        logging.error(f"Error: Failed to reset training state, exiting: {e}")
+        with lock:
+            connection.send({"type": "exit", "code": code, "restart": True})
+        sys.exit(1)
+    logging.info(
+        f"Job exited with {code} after {time.monotonic() - start:.1f}s")
+    with lock:
+        connection.send({"type": "exit", "code": code})
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--address", required=True)
+    parser.add_argument("--backend", choices=sorted(backends), default="plain")
+    args = parser.parse_args()
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(),
+                        format="%(asctime)s - %(levelname)s - training daemon - %(message)s")
+    # Between jobs the preemption signal has nothing to do
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+
+    start = time.monotonic()
+    backend = backends[args.backend]()
+    authkey = bytes.fromhex(os.environ.pop("TRAINING_DAEMON_AUTHKEY"))
+    with Listener(args.address, family="AF_UNIX", authkey=authkey) as listener:
+        logging.info(
+            f"Ready in {time.monotonic() - start:.1f}s ({args.backend} backend)")
+        with listener.accept() as connection:
+            lock = threading.Lock()
+            while True:
+                try:
+                    message = connection.recv()
+                except EOFError:
+                    break
+                if message["type"] == "train":
+                    run_job(backend, connection, lock,
+                            message["argv"], message["env"])
+    logging.info("Worker disconnected, exiting")
+
+
+if __name__ == "__main__":
+    main()
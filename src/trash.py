@@ -0,0 +1,115 @@
+import collections
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+
+class Trash:
+    # Tears directories down without waiting for them to be deleted: they are
+    # renamed into a trash directory next to them (on the same filesystem, so
+    # the rename is instant) and deleted by a background reaper at the lowest
+    # CPU priority, which the kernel's I/O schedulers also take as a lower
+    # I/O priority. Whoever needs the space back waits for it with
+    # wait_for_space.
+    def __init__(self, folder_name):
+        self.folder_name = folder_name
+        self.pending = collections.deque()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def trash_dir(self, path):
+        return os.path.join(os.path.dirname(os.path.abspath(path)), self.folder_name)
+
+    def discard(self, path):
+        path = os.path.abspath(path)
+        trash_dir = self.trash_dir(path)
+        target = os.path.join(
+            trash_dir, f"{os.path.basename(path)}-{uuid.uuid4().hex}")
+        try:
+            os.makedirs(trash_dir, exist_ok=True)
+            os.rename(path, target)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            # A mount point cannot be renamed away, it is emptied in place
+            logging.warning(f"Deleting {path} in place: {e}")
+            for entry in os.scandir(path):
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    os.remove(entry.path)
+            return
+        self.queue([target])
+
+    def reset(self, path):
+        # Leaves an empty directory at path
+        self.discard(path)
+        os.makedirs(path, exist_ok=True)
+
+    def sweep(self, path):
+        # Queues what a previous run left in the trash next to path
+        trash_dir = self.trash_dir(path)
+        if not os.path.isdir(trash_dir):
+            return
+        with self.condition:
+            queued = set(self.pending)
+        self.queue([entry.path for entry in os.scandir(trash_dir)
+                    if entry.path not in queued])
+
+    def queue(self, paths):
+        if len(paths) == 0:
+            return
+        with self.condition:
+            self.pending.extend(paths)
+            self.condition.notify_all()
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.reap, name="trash-reaper", daemon=True)
+                self.thread.start()
+
+    def reap(self):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError) as e:
+            logging.info(f"Trash reaper runs at normal priority: {e}")
+        while True:
+            with self.condition:
+                while len(self.pending) == 0:
+                    self.condition.wait()
+                path = self.pending[0]
+            start = time.monotonic()
+            shutil.rmtree(path, ignore_errors=True)
+            with self.condition:
+                self.pending.popleft()
+                self.condition.notify_all()
+            logging.info(
+                f"Deleted {path} in {time.monotonic() - start:.1f}s")
+
+    def wait_for_space(self, path, min_free_bytes):
+        # Waits until the filesystem of path has min_free_bytes free, for as
+        # long as the reaper has something left to delete. Returns whether
+        # there is enough space.
+        start = time.monotonic()
+        with self.condition:
+            while True:
+                free = shutil.disk_usage(path).free
+                if free >= min_free_bytes:
+                    break
+                if len(self.pending) == 0:
+                    logging.warning(
+                        f"Only {free / 1024 / 1024 / 1024:.1f} GB free for {path}, "
+                        f"{min_free_bytes / 1024 / 1024 / 1024:.1f} GB wanted")
+                    return False
+                # Space comes back while a large tree is being deleted
+                self.condition.wait(1)
+        waited = time.monotonic() - start
+        if waited > 0.1:
+            logging.info(
+                f"Waited {waited:.1f}s for the trash reaper to free disk space for {path}")
+        return True
+
+
+trash = Trash(".trash")
@@ -1,69 +1,524 @@
+import hashlib
+import json
+import logging
 import math
 import os
-from api import get_api_session
+import threading
+import time
+from requests import ConnectionError, HTTPError
+from api import JobThreadPoolExecutor, get_api_session, token_cache
+from integrity import IntegrityError, content_md5, verify_md5
 import concurrent.futures
 import config
+import tracing
 
 # Configure the part size to be 10MB. 5MB is the minimum part size, except for the last part
 partsize = 10 * 1024 * 1024
 
+# Maximum number of parts uploaded at the same time for one upload
+max_concurrent_parts = 25
 
-def upload_file(filename, bucket, key):
-    global partsize
+# Cleared the first time the API turns down a single request upload
+single_request_supported = True
 
-    api = get_api_session()
+
+def part_size_for(size):
+    # Grow parts in whole megabytes once a file would need more than
+    # config.upload_max_parts of the default size
+    megabyte = 1024 * 1024
+    return max(partsize, math.ceil(size / config.upload_max_parts / megabyte) * megabyte)
+
+
+class UploadCanceled(Exception):
+    pass
+
+
+class PartBufferPool:
+    # Hands out reusable part-sized buffers. Buffers are allocated lazily, and
+    # never more than `max_bytes` worth of them, so acquire() blocks (applying
+    # backpressure to whoever is producing parts) until one is released.
+    def __init__(self, partsize, max_bytes):
+        self.partsize = partsize
+        self.capacity = max(1, max_bytes // partsize)
+        self.free = []
+        self.allocated = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while len(self.free) == 0 and self.allocated >= self.capacity:
+                self.condition.wait()
+            if len(self.free) > 0:
+                return self.free.pop()
+            self.allocated += 1
+            return bytearray(self.partsize)
+
+    def release(self, buffer):
+        with self.condition:
+            self.free.append(buffer)
+            self.condition.notify()
+
+
+class AdaptiveConcurrency:
+    # Limits the number of parts in flight, adjusting the limit from observed
+    # throughput. After each window of parts the limit is raised while the
+    # aggregate rate keeps improving, and lowered again when it drops.
+    def __init__(self, initial, maximum):
+        self.maximum = maximum
+        self.limit = max(1, min(initial, maximum))
+        self.active = 0
+        self.condition = threading.Condition()
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+        self.window_parts = 0
+        self.last_rate = None
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def release(self, sent_bytes):
+        with self.condition:
+            self.active -= 1
+            self.window_bytes += sent_bytes
+            self.window_parts += 1
+            if self.window_parts >= self.limit:
+                now = time.monotonic()
+                rate = self.window_bytes / max(now - self.window_start, 1e-6)
+                if self.last_rate is None or rate > self.last_rate * 1.1:
+                    self.limit = min(self.limit + 1, self.maximum)
+                elif rate < self.last_rate * 0.9:
+                    self.limit = max(self.limit - 1, 1)
+                self.last_rate = rate
+                self.window_start = now
+                self.window_bytes = 0
+                self.window_parts = 0
+            self.condition.notify_all()
+
+
+def log_throughput(key, size, elapsed, detail):
+    megabytes = size / 1024 / 1024
+    logging.info(
+        f"Uploaded {key}: {megabytes:.1f} MB in {elapsed:.2f}s ({megabytes / max(elapsed, 1e-6):.1f} MB/s, {detail})")
+
+
+def get_upload_token(api, bucket, key):
+    return token_cache.get("upload", bucket, key,
+                           lambda: fetch_upload_token(api, bucket, key))
+
+
+@tracing.traced("upload")
+def fetch_upload_token(api, bucket, key):
     token_url = f"{config.api_base_url}/upload/token"
-    upload_token = api.get(
+    return api.get(
         token_url, params={"bucket": bucket, "key": key}).json()["token"]
 
+
+@tracing.traced("upload")
+def create_multipart_upload(api, bucket, key):
+    upload_token = get_upload_token(api, bucket, key)
+
     url = f"{config.api_base_url}/upload/{bucket}/{key}"
 
     # Create the multipart upload
     uploadId = api.post(
         url, params={"action": "mpu-create"}, headers={'x-upload-token': upload_token}).json()["uploadId"]
 
-    part_count = math.ceil(os.stat(filename).st_size / partsize)
-    # Create an executor for up to 25 concurrent uploads.
-    executor = concurrent.futures.ThreadPoolExecutor(25)
-    # Submit a task to the executor to upload each part
-    futures = [
-        executor.submit(upload_part, filename, partsize,
-                        url, uploadId, index, upload_token)
-        for index in range(part_count)
-    ]
-    concurrent.futures.wait(futures)
-    # get the parts from the futures
-    uploaded_parts = [future.result() for future in futures]
+    return url, uploadId, upload_token
 
-    # complete the multipart upload
+
+@tracing.traced("upload")
+def complete_multipart_upload(api, url, uploadId, token, uploaded_parts):
+    # Raises if the upload could not be completed, the object does not exist
+    # then
     response = api.post(
         url,
         params={"action": "mpu-complete", "uploadId": uploadId},
-        headers={'x-upload-token': upload_token},
+        headers={'x-upload-token': token},
         json={"parts": uploaded_parts},
     )
-    if response.status_code == 200:
-        print("completed multipart upload")
-    else:
-        print(response.text)
+    if response.status_code != 200:
+        logging.error(
+            f"Error: Failed to complete multipart upload of {url}: {response.status_code} {response.text}")
+        raise HTTPError(
+            f"{response.status_code} completing multipart upload of {url}", response=response)
+    print("completed multipart upload")
 
 
-def upload_part(filename, partsize, url, uploadId, index, token):
-    # Open the file in rb mode, which treats it as raw bytes rather than attempting to parse utf-8
-    with open(filename, "rb") as file:
-        file.seek(partsize * index)
-        part = file.read(partsize)
+def abort_multipart_upload(api, bucket, key, uploadId):
+    # Frees the parts of an upload that will not be completed. Failing to is
+    # only logged, the storage backend expires them eventually.
+    url = f"{config.api_base_url}/upload/{bucket}/{key}"
+    try:
+        response = api.delete(url, params={"action": "mpu-abort", "uploadId": uploadId},
+                              headers={'x-upload-token': get_upload_token(api, bucket, key)})
+        response.raise_for_status()
+    except Exception as e:
+        logging.warning(f"Failed to abort upload of {key}: {e}")
+
+
+class UploadManifest:
+    # On-disk record of a multipart upload in progress, so a failed upload is
+    # retried without re-sending the parts that already made it. A worker
+    # that restarts cannot resume them (the files are produced again), so
+    # what is left at startup is aborted.
+    def __init__(self, bucket, key, uploadId, partsize, size, mtime, parts=None):
+        self.bucket = bucket
+        self.key = key
+        self.uploadId = uploadId
+        self.partsize = partsize
+        self.size = size
+        self.mtime = mtime
+        self.parts = parts or {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def path(bucket, key):
+        name = hashlib.sha256(f"{bucket}/{key}".encode()).hexdigest()
+        return os.path.join(config.upload_state_dir, f"{name}.json")
+
+    @classmethod
+    def load(cls, bucket, key):
+        return cls.read(cls.path(bucket, key))
+
+    @classmethod
+    def read(cls, path):
+        try:
+            with open(path) as file:
+                return cls(**json.load(file))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable upload manifest {path}: {e}")
+            return None
+
+    def matches(self, bucket, key, partsize, stat):
+        return (self.bucket, self.key, self.partsize, self.size, self.mtime) == (
+            bucket, key, partsize, stat.st_size, stat.st_mtime_ns)
+
+    def record_part(self, index, part):
+        with self.lock:
+            self.parts[str(index + 1)] = part
+            self.save()
+
+    def uploaded_parts(self):
+        return [self.parts[number] for number in sorted(self.parts, key=int)]
+
+    def save(self):
+        path = self.path(self.bucket, self.key)
+        with open(f"{path}.tmp", "w") as file:
+            json.dump({
+                "bucket": self.bucket,
+                "key": self.key,
+                "uploadId": self.uploadId,
+                "partsize": self.partsize,
+                "size": self.size,
+                "mtime": self.mtime,
+                "parts": self.parts,
+            }, file)
+        os.replace(f"{path}.tmp", path)
+
+    def remove(self):
+        try:
+            os.remove(self.path(self.bucket, self.key))
+        except FileNotFoundError:
+            pass
+
 
-    # Retry policy for when uploading a part fails
+def abort_stale_uploads():
+    # Called at startup, before anything is uploaded
     api = get_api_session()
-    api.headers.update({"x-upload-token": token})
+    for entry in os.scandir(config.upload_state_dir):
+        if not entry.name.endswith(".json"):
+            continue
+        manifest = UploadManifest.read(entry.path)
+        if manifest is not None:
+            logging.info(
+                f"Aborting upload of {manifest.key} left by a previous run")
+            abort_multipart_upload(
+                api, manifest.bucket, manifest.key, manifest.uploadId)
+        os.remove(entry.path)
 
-    return api.put(
+
+def raise_first_failure(futures):
+    for future in futures:
+        if future.done() and future.exception() is not None:
+            raise future.exception()
+
+
+@tracing.traced("upload", size=lambda result, *args: result["size"])
+def upload_file(filename, bucket, key):
+    # Returns the size and SHA-256 of what was uploaded
+    start = time.monotonic()
+    stat = os.stat(filename)
+    if single_request_supported and stat.st_size <= config.upload_single_request_max_bytes:
+        api = get_api_session()
+        sha256 = put_file(api, filename, bucket, key)
+        if sha256 is not None:
+            log_throughput(key, stat.st_size,
+                           time.monotonic() - start, "single request")
+            return {"size": stat.st_size, "sha256": sha256}
+
+    file_partsize = part_size_for(stat.st_size)
+    pool = PartBufferPool(file_partsize, config.upload_max_inflight_bytes)
+    concurrency = AdaptiveConcurrency(
+        config.upload_initial_concurrency, min(max_concurrent_parts, pool.capacity))
+    # One session for every part, so connections are reused between parts
+    api = get_api_session(pool_size=concurrency.maximum)
+
+    manifest = UploadManifest.load(bucket, key)
+    if manifest is not None and not manifest.matches(bucket, key, file_partsize, stat):
+        abort_multipart_upload(api, bucket, key, manifest.uploadId)
+        manifest.remove()
+        manifest = None
+
+    # A failed attempt is resumed: only the parts missing from the manifest
+    # are sent again
+    for attempt in range(1, config.upload_attempts + 1):
+        if manifest is None:
+            _, uploadId, _ = create_multipart_upload(api, bucket, key)
+            manifest = UploadManifest(bucket, key, uploadId,
+                                      file_partsize, stat.st_size, stat.st_mtime_ns)
+            manifest.save()
+        elif len(manifest.parts) > 0:
+            logging.info(
+                f"Resuming upload of {key}: {len(manifest.parts)} parts already uploaded")
+        try:
+            sha256 = send_parts(api, pool, concurrency, filename, manifest)
+            manifest.remove()
+            break
+        except (HTTPError, ConnectionError, IntegrityError) as e:
+            if attempt == config.upload_attempts:
+                abort_multipart_upload(api, bucket, key, manifest.uploadId)
+                manifest.remove()
+                raise e
+            logging.warning(
+                f"Upload of {key} failed (attempt {attempt} of {config.upload_attempts}): {e}")
+            if isinstance(e, HTTPError) and e.response is not None and e.response.status_code == 404:
+                # The upload has expired or been aborted, start over
+                manifest.remove()
+                manifest = None
+            time.sleep(attempt)
+    log_throughput(key, stat.st_size, time.monotonic() - start,
+                   f"{math.ceil(stat.st_size / file_partsize)} parts of {file_partsize // 1024 // 1024} MB, concurrency {concurrency.limit}")
+    return {"size": stat.st_size, "sha256": sha256}
+
+
+@tracing.traced("upload", size=lambda result, api, filename, *args: os.path.getsize(filename))
+def put_file(api, filename, bucket, key):
+    # Small files skip the multipart handshake. If the API does not accept
+    # plain uploads, remember that and use multipart from then on. Only the
+    # statuses of a missing route or method count: anything else, e.g. a 400
+    # for a bad token, fails this upload without changing how the rest are
+    # sent. Returns the SHA-256 of the file, or None if it was not uploaded.
+    global single_request_supported
+
+    upload_token = get_upload_token(api, bucket, key)
+    url = f"{config.api_base_url}/upload/{bucket}/{key}"
+    with open(filename, "rb") as file:
+        data = file.read()
+    headers = {'x-upload-token': upload_token}
+    md5_hex, md5_header = content_md5(data)
+    if config.upload_content_md5:
+        headers["Content-MD5"] = md5_header
+    response = api.put(url, headers=headers, data=data)
+    if response.status_code in (404, 405, 501):
+        logging.info(
+            f"Single request uploads are not supported ({response.status_code}), using multipart uploads.")
+        single_request_supported = False
+        return None
+    if response.status_code in (401, 403):
+        token_cache.discard(upload_token)
+    response.raise_for_status()
+    verify_md5(response.headers.get("ETag"), md5_hex, key)
+    return hashlib.sha256(data).hexdigest()
+
+
+def send_parts(api, pool, concurrency, filename, manifest, upload_token=None):
+    # Parts are read here, in order, so the SHA-256 of the whole file is
+    # computed as it is sent. Parts uploaded before a resume are read and
+    # hashed, but not sent again. Returns the SHA-256.
+    if upload_token is None:
+        upload_token = get_upload_token(api, manifest.bucket, manifest.key)
+    url = f"{config.api_base_url}/upload/{manifest.bucket}/{manifest.key}"
+
+    part_count = math.ceil(manifest.size / manifest.partsize)
+    digest = hashlib.sha256()
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        with JobThreadPoolExecutor(concurrency.maximum) as executor:
+            futures = []
+            for index in range(part_count):
+                raise_first_failure(futures)
+                uploaded = str(index + 1) in manifest.parts
+                # Blocks while the concurrency limit or the in-flight byte
+                # budget is used up
+                if not uploaded:
+                    concurrency.acquire()
+                buffer = pool.acquire()
+                # Read the part straight into a reused buffer and send a view
+                # of it, so no per-part bytes objects are allocated
+                size = os.preadv(fd, [buffer], manifest.partsize * index)
+                with memoryview(buffer) as view, view[:size] as part:
+                    digest.update(part)
+                if uploaded:
+                    pool.release(buffer)
+                    continue
+                futures.append(executor.submit(
+                    upload_part, api, buffer, size, pool, concurrency, url, manifest, index, upload_token))
+            concurrent.futures.wait(futures)
+            raise_first_failure(futures)
+    finally:
+        os.close(fd)
+
+    # complete the multipart upload
+    complete_multipart_upload(
+        api, url, manifest.uploadId, upload_token, manifest.uploaded_parts())
+    return digest.hexdigest()
+
+
+def upload_part(api, buffer, size, pool, concurrency, url, manifest, index, token):
+    try:
+        with memoryview(buffer) as view, view[:size] as part:
+            uploaded = upload_part_data(
+                api, part, url, manifest.uploadId, index, token)
+    finally:
+        pool.release(buffer)
+        concurrency.release(size)
+    manifest.record_part(index, uploaded)
+    return uploaded
+
+
+@tracing.traced("upload", size=lambda result, api, part, *args: len(part))
+def upload_part_data(api, part, url, uploadId, index, token):
+    headers = {"x-upload-token": token}
+    md5_hex, md5_header = content_md5(part)
+    if config.upload_content_md5:
+        headers["Content-MD5"] = md5_header
+    response = api.put(
         url,
         params={
             "action": "mpu-uploadpart",
             "uploadId": uploadId,
             "partNumber": str(index + 1),
         },
+        headers=headers,
         data=part,
-    ).json()
+    )
+    if response.status_code in (401, 403):
+        token_cache.discard(token)
+    response.raise_for_status()
+    uploaded = response.json()
+    verify_md5(uploaded.get("etag"), md5_hex, f"part {index + 1} of {url}")
+    return uploaded
+
+
+class MultipartUploadWriter:
+    # A write-only, non-seekable file object that turns whatever is written to it
+    # into a multipart upload. Every time a part buffer fills up it is handed to
+    # the thread pool, so producing the next part (e.g. compressing a
+    # checkpoint) overlaps with uploading the previous one. Buffers come from a
+    # PartBufferPool, so writers block once the in-flight byte budget is used.
+    # Setting the `cancel` event makes the next write raise UploadCanceled.
+    def __init__(self, bucket, key, cancel=None):
+        self.bucket = bucket
+        self.key = key
+        self.cancel = cancel
+        self.pool = PartBufferPool(partsize, config.upload_max_inflight_bytes)
+        self.concurrency = AdaptiveConcurrency(
+            config.upload_initial_concurrency, min(max_concurrent_parts, self.pool.capacity))
+        self.api = get_api_session(pool_size=self.concurrency.maximum)
+        self.url, self.uploadId, self.token = create_multipart_upload(
+            self.api, bucket, key)
+        self.executor = JobThreadPoolExecutor(self.concurrency.maximum)
+        self.start = time.monotonic()
+        self.digest = hashlib.sha256()
+        self.futures = []
+        self.buffer = None
+        self.filled = 0
+        self.position = 0
+        self.closed = False
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def write(self, data):
+        if self.cancel is not None and self.cancel.is_set():
+            raise UploadCanceled(self.key)
+        with memoryview(data) as view, view.cast("B") as source:
+            self.digest.update(source)
+            offset = 0
+            while offset < len(source):
+                if self.buffer is None:
+                    self.buffer = self.pool.acquire()
+                    self.filled = 0
+                count = min(len(source) - offset,
+                            len(self.buffer) - self.filled)
+                self.buffer[self.filled:self.filled +
+                            count] = source[offset:offset + count]
+                self.filled += count
+                offset += count
+                if self.filled == len(self.buffer):
+                    self._submit_part()
+        self.position += offset
+        return offset
+
+    def _submit_part(self):
+        raise_first_failure(self.futures)
+        buffer, size = self.buffer, self.filled
+        self.buffer = None
+        self.concurrency.acquire()
+        self.futures.append(self.executor.submit(
+            self._upload_buffer, buffer, size, len(self.futures)))
+
+    def _upload_buffer(self, buffer, size, index):
+        try:
+            with memoryview(buffer) as view, view[:size] as part:
+                return upload_part_data(self.api, part, self.url, self.uploadId, index, self.token)
+        finally:
+            self.pool.release(buffer)
+            self.concurrency.release(size)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            # The last part is allowed to be smaller than the minimum part size
+            if self.buffer is None and len(self.futures) == 0:
+                self.buffer = self.pool.acquire()
+                self.filled = 0
+            if self.buffer is not None:
+                self._submit_part()
+            concurrent.futures.wait(self.futures)
+            uploaded_parts = [future.result() for future in self.futures]
+        finally:
+            self.executor.shutdown()
+        complete_multipart_upload(
+            self.api, self.url, self.uploadId, self.token, uploaded_parts)
+        log_throughput(self.key, self.position, time.monotonic() - self.start,
+                       f"{len(uploaded_parts)} parts streamed, concurrency {self.concurrency.limit}")
+
+    def sha256(self):
+        return self.digest.hexdigest()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.closed = True
+            self.executor.shutdown(cancel_futures=True)
@@ -0,0 +1,144 @@
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing.connection import Client
+import config
+
+
+class WarmJob:
+    # Takes the place of the Popen of a training process for a job run by a
+    # training daemon. The job's output is relayed into a pipe for the
+    # progress reader, and signals sent to its pid reach the daemon.
+    def __init__(self, daemon):
+        self.daemon = daemon
+        self.pid = daemon.process.pid
+        self.returncode = None
+        self.done = threading.Event()
+        read_fd, write_fd = os.pipe()
+        self.stdout = os.fdopen(read_fd, "rb")
+        self.output = os.fdopen(write_fd, "wb")
+        self.thread = threading.Thread(target=self.relay, daemon=True)
+
+    def relay(self):
+        code = None
+        try:
+            while code is None:
+                message = self.daemon.connection.recv()
+                if message["type"] == "output":
+                    self.output.write(message["data"])
+                    self.output.flush()
+                elif message["type"] == "exit":
+                    code = message["code"]
+                    if message.get("restart"):
+                        # So the next job starts a new daemon
+                        self.daemon.process.wait()
+                        self.daemon.close()
+        except (EOFError, OSError):
+            # The daemon died, or was killed to stop the job
+            code = self.daemon.process.wait()
+            self.daemon.close()
+        finally:
+            self.output.close()
+            self.returncode = code
+            self.done.set()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        self.done.wait()
+        return self.returncode
+
+
+class TrainingDaemon:
+    # A long-lived training process (train_daemon.py) that runs a slot's jobs
+    # one after another. It is started on first use, and again after it
+    # exits, e.g. when it was killed to stop a job.
+    def __init__(self, slot):
+        self.slot = slot
+        self.process = None
+        self.connection = None
+        self.directory = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.process is not None and self.process.poll() is None:
+                return
+            self.close()
+            start = time.monotonic()
+            self.directory = tempfile.mkdtemp(prefix="training-daemon-")
+            address = os.path.join(self.directory, "socket")
+            authkey = os.urandom(32)
+            env = {**os.environ, **self.slot.environment(),
+                   "TRAINING_DAEMON_AUTHKEY": authkey.hex()}
+            self.process = subprocess.Popen(
+                [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "train_daemon.py"),
+                 f"--address={address}", f"--backend={config.training_daemon_backend}"],
+                env=env, start_new_session=True)
+            while self.connection is None:
+                if self.process.poll() is not None:
+                    raise RuntimeError(
+                        f"Training daemon for {self.slot} exited with {self.process.returncode}")
+                try:
+                    self.connection = Client(
+                        address, family="AF_UNIX", authkey=authkey)
+                except (FileNotFoundError, ConnectionRefusedError):
+                    time.sleep(0.1)
+            logging.info(
+                f"Training daemon for {self.slot} started in {time.monotonic() - start:.1f}s")
+
+    def run(self, argv, env):
+        # Starts a job, argv is the training script and its arguments, env
+        # what to add to the daemon's environment for the job
+        self.start()
+        job = WarmJob(self)
+        self.connection.send({"type": "train", "argv": argv, "env": env})
+        job.thread.start()
+        return job
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+
+daemons = {}
+daemons_lock = threading.Lock()
+
+
+def daemon_for(slot):
+    # The daemon runs the training script in one process, so slots with
+    # several GPUs keep launching it with TRAINING_LAUNCHER
+    if not config.training_daemon:
+        return None
+    if slot.devices is not None and len(slot.devices) > 1:
+        return None
+    with daemons_lock:
+        if slot.index not in daemons:
+            daemons[slot.index] = TrainingDaemon(slot)
+        return daemons[slot.index]
+
+
+def start_daemons(slots):
+    # Daemons import their libraries while the worker waits for work
+    for slot in slots:
+        daemon = daemon_for(slot)
+        if daemon is not None:
+            threading.Thread(target=start_daemon,
+                             args=(daemon,), daemon=True).start()
+
+
+def start_daemon(daemon):
+    try:
+        daemon.start()
+    except Exception as e:
+        logging.error(f"Error: Failed to start training daemon: {e}")
@@ -1,9 +1,11 @@
 from api import get_api_session
 import config
 import logging
+import metrics
+import progress
 
 
-def send_webhook(url, bucket_name, key, job_id):
+def send_webhook(url, bucket_name, key, job_id, extra=None):
     api = get_api_session()
     try:
         if url is None:
@@ -18,6 +20,7 @@ def send_webhook(url, bucket_name, key, job_id):
             "project_name": config.salad_project_name,
             "container_group_name": config.salad_container_group_name,
             "job_id": job_id,
+            **(extra or {}),
         }
         payload = {k: v for k, v in payload.items() if v is not None}
 
@@ -28,22 +31,25 @@ def send_webhook(url, bucket_name, key, job_id):
         logging.error(e.response.json() if hasattr(e, "response") else e)
 
 
-def send_progress_webhook(bucket_name, key, job_id):
+def send_progress_webhook(bucket_name, key, job_id, checksum=None):
+    # checksum is the size and SHA-256 of the uploaded object
     url = config.api_base_url + "/progress"
     logging.info(f"Reporting Job Progress: {key} uploaded for job {job_id}")
-    send_webhook(url, bucket_name, key, job_id)
+    send_webhook(url, bucket_name, key, job_id, {"checksum": checksum})
 
 
-def send_complete_webhook(bucket_name, key, job_id):
+def send_complete_webhook(bucket_name, key, job_id, checksum=None):
     url = config.api_base_url + "/complete"
     logging.info(f"Reporting Job Complete: {key} uploaded for job {job_id}")
-    send_webhook(url, bucket_name, key, job_id)
+    send_webhook(url, bucket_name, key, job_id,
+                 {"metrics": metrics.job_summary(job_id), "checksum": checksum})
 
 
 def send_failed_webhook(bucket_name, key, job_id):
     url = config.api_base_url + "/fail"
     logging.info(f"Reporting Job Failed: {key} uploaded for job {job_id}")
-    send_webhook(url, bucket_name, key, job_id)
+    send_webhook(url, bucket_name, key, job_id,
+                 {"metrics": metrics.job_summary(job_id)})
 
 
 def send_heartbeat(job_id):
@@ -55,6 +61,7 @@ def send_heartbeat(job_id):
         "organization_name": config.salad_organization_name,
         "project_name": config.salad_project_name,
         "container_group_name": config.salad_container_group_name,
+        "progress": progress.get(job_id),
     }
     payload = {k: v for k, v in payload.items() if v is not None}
     response = api.post(url, json=payload)
@@ -0,0 +1,130 @@
+import collections
+import logging
+import random
+import threading
+import time
+from requests import HTTPError
+from api import get_api_session
+import config
+import metrics
+from webhooks import send_heartbeat
+
+
+def fetch_work(wait_seconds=0):
+    # Returns the jobs the API handed us, possibly none. With wait_seconds,
+    # the API is asked to hold the request until work is available.
+    api = get_api_session()
+    url = config.api_base_url + "/work"
+    params = {
+        "machine_id": config.salad_machine_id,
+        "container_group_id": config.salad_container_group_id,
+        "organization_name": config.salad_organization_name,
+        "project_name": config.salad_project_name,
+        "container_group_name": config.salad_container_group_name,
+    }
+    timeout = None
+    if wait_seconds > 0:
+        params["wait"] = wait_seconds
+        timeout = wait_seconds + 30
+    response = api.get(url, params=params, timeout=timeout)
+    response.raise_for_status()
+    return response.json()
+
+
+class WorkPoller:
+    # Polls for work with exponential backoff while the queue is empty, with
+    # jitter so idle nodes spread their polls out instead of hitting the API
+    # in lockstep. The interval drops back to the minimum as soon as a job
+    # turns up. Jobs beyond the first one in a response are kept and handed
+    # out before the API is asked again, with heartbeats sent for them while
+    # they wait.
+    def __init__(self, fetch, min_interval, max_interval, long_poll_seconds):
+        self.fetch = fetch
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.long_poll_seconds = long_poll_seconds
+        self.interval = min_interval
+        self.queue = collections.deque()
+        self.lock = threading.Lock()
+        self.heartbeat_thread = None
+
+    def poll(self):
+        # One attempt at getting a job, without waiting between polls
+        with self.lock:
+            if len(self.queue) > 0:
+                return self.queue.popleft()
+        metrics.increment("work_polls")
+        jobs = self.fetch(self.long_poll_seconds)
+        if len(jobs) == 0:
+            metrics.increment("work_polls_empty")
+            return None
+        with self.lock:
+            self.queue.extend(jobs[1:])
+            if len(self.queue) > 0 and self.heartbeat_thread is None:
+                self.heartbeat_thread = threading.Thread(
+                    target=self.heartbeat, daemon=True)
+                self.heartbeat_thread.start()
+        if len(jobs) > 1:
+            logging.info(f"Queued {len(jobs) - 1} more jobs from the API")
+        return jobs[0]
+
+    def heartbeat(self):
+        # Keeps the queued jobs claimed until they are handed out. Jobs the
+        # API canceled in the meantime are dropped.
+        while True:
+            with self.lock:
+                if len(self.queue) == 0:
+                    self.heartbeat_thread = None
+                    return
+                queued = list(self.queue)
+            for job in queued:
+                try:
+                    send_heartbeat(job["id"])
+                except HTTPError as e:
+                    if e.response is not None and e.response.status_code == 400:
+                        logging.info(
+                            f"Queued job {job['id']} has been canceled.")
+                        with self.lock:
+                            if job in self.queue:
+                                self.queue.remove(job)
+                    else:
+                        logging.error(f"Error: {e}")
+                except Exception as e:
+                    logging.error(f"Error: {e}")
+            time.sleep(config.heartbeat_interval)
+
+    def wait_for_work(self, keep_polling):
+        # Polls until a job is available or keep_polling() turns false.
+        # The time spent idle is recorded against the job that ends it.
+        start = time.monotonic()
+        polls = 0
+        while keep_polling():
+            poll_start = time.monotonic()
+            polls += 1
+            try:
+                job = self.poll()
+            except Exception as e:
+                metrics.increment("work_poll_errors")
+                logging.error(f"Error: Failed to poll for work: {e}")
+                job = None
+            if job is not None:
+                self.interval = self.min_interval
+                metrics.record_phase(
+                    job["id"], "wait_for_work", time.monotonic() - start, 0)
+                logging.info(
+                    f"Got work after {time.monotonic() - start:.1f}s idle and {polls} polls")
+                return job
+            # A long poll that was held by the API already spent its share
+            # of the interval waiting
+            delay = random.uniform(self.interval / 2, self.interval) - \
+                (time.monotonic() - poll_start)
+            self.interval = min(self.interval * 2, self.max_interval)
+            if delay > 0:
+                logging.info(
+                    f"No work available. Sleeping for {delay:.1f} seconds...")
+                time.sleep(delay)
+        return None
+
+
+work_poller = WorkPoller(fetch_work, config.work_poll_min_seconds,
+                         config.work_poll_max_seconds, config.work_long_poll_seconds)